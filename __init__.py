@@ -4,9 +4,9 @@ Takes an video file (approx 10h) and slowly pulls the matches in the video out
 and makes those seperate files.
 
 Various possibilites and operations.
-test, parse, finish, upload
+test, parse, finish, watch, upload
 
-spaceraid {parse,finish,upload,test} source_file ... target_dir
+spaceraid {parse,finish,watch,upload,test} source_file ... target_dir
 (global)
 --help
 --version             Print version info and exit.
@@ -18,7 +18,7 @@ test      Run a test to see if the video is readable.
                       a video.
 -a  --answers        Actual results for the video so they can be compared to.
 
-parse     Actually analyize the video file.
+parse     Actually analyize the video file, or a folder of them.
 
 finish    Fixup the output video files. Add intro and fix name.
 -t --tags [all|yellow|green]
@@ -26,6 +26,11 @@ finish    Fixup the output video files. Add intro and fix name.
                       green and not red. Default is green. Yellow is will
                       process videos with yellow flags but not green.
 
+watch     Follow the folder(s) the recorder writes into and cut each match
+          as soon as it ends.
+--finish              Also finish each clip.
+--idle-exit seconds   Stop after this long without a change.
+
 upload    Upload the file to youtube.
 run       Do parse, finish, and probably upload. Run will be done if no
           command is given if I can figure out how to add that.
@@ -53,7 +58,6 @@ import time
 import xattr
 import logging
 import argparse
-import subprocess
 
 logging.basicConfig(
     format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
@@ -63,6 +67,11 @@ try:
     import find_matches
     import process_frames
     import video_loader # This should be removed at some point.
+    import scan_cache
+    import ffmpeg_pool
+    import intro_cache
+    import manifest
+    import watcher
     import test_reader
 except ImportError:
     sys.stderr.write(
@@ -195,6 +204,11 @@ parser.add_argument("-l", "--log", "--log-file", type = PathType(exists = None),
 
 parser.add_argument("-d", "--data-log", type = PathType(exists = None))
 
+parser.add_argument("-b", "--backend", choices = sorted(video_loader.BACKENDS),
+                    default = "cv2", help = "How to decode the video. "
+                    "ffmpeg does the decoding, scaling and cropping in an "
+                    "ffmpeg process. (Default cv2).")
+
 # Subparsers / Operations
 subparsers = parser.add_subparsers(
     dest = "operation_name", title = "Operations",
@@ -227,7 +241,7 @@ def run(namespace):
                 results = find_matches.scan_video(video)
                 # Close the windows.
                 video_loader.close_image()
-                timings = find_matches.time_video(results)
+                timings = find_matches.refine_matches(video, results)
                 find_matches.write_files(video, timings)
             except ValueError:
                 # The file stopped existing. Error.
@@ -243,53 +257,154 @@ del parser_run # No need to keep varible.
 #################################### Parse #####################################
 parser_parse = subparsers.add_parser("parse", help = "Analyze the video(s).")
 
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".m4v", ".mkv", ".avi", ".ts")
+
+def find_videos(sources):
+    """Expand the folders in sources to the videos in them, by name."""
+    videos = []
+    for source in sources:
+        if os.path.isdir(source):
+            videos.extend(sorted(
+                os.path.join(source, name) for name in os.listdir(source)
+                if name.lower().endswith(VIDEO_EXTENSIONS) and
+                   os.path.isfile(os.path.join(source, name))))
+        else:
+            videos.append(source)
+    return videos
+
 def parse(namespace):
-    """Parse operation for spaceraid."""
+    """Parse operation for spaceraid.
+       source_files can be videos or folders of them (like a whole event).
+       Each video's results and clips are written as soon as it is done,
+       while the next one is being read. With more than one video, each
+       gets a folder of its own in target_dir.
+       What is done is kept in a manifest.Manifest in target_dir, so a
+       stopped parse goes on where it stopped.
+    """
+    global results, timings
+    videos = find_videos(namespace.source_files)
+    out_dir = namespace.target_dir
+    if not os.path.exists(out_dir):
+        # Make the directory.
+        os.mkdir(out_dir)
+        logging.debug("Created folder %r" % out_dir)
+    record = manifest.Manifest(out_dir) if os.path.isdir(out_dir) else None
+
+    executor = None
+    scanner = None
+    scans = {}
+    # Clips are cut on this thread while the next video is read.
+    writer = ffmpeg_pool.FFmpeg_Pool(1)
+    writing = []
     try:
         process_frames.init()
-
-        for f in namespace.source_files:
+        if namespace.workers:
+            # Read the frames on a pool of processes.
+            executor = process_frames.Frame_Executor(namespace.workers)
+        if namespace.processes:
+            # Hand out every video now. The workers go straight from the
+            # parts of one video to the next, and don't wait for the results
+            # to be written.
+            scanner = find_matches.Scan_Pool(namespace.processes)
+            # Each video is only opened by the worker that scans it.
+            for f in videos:
+                if record is not None and record.get_matches(f) is not None:
+                    continue # Already found the matches.
+                if not os.path.isfile(f):
+                    continue # Told about below.
+                scans[f] = scanner.submit(f, namespace.backend,
+                                          get_data_log(namespace))
+
+        for f in videos:
             if not os.path.isfile(f):
                 logging.error("File %r does not exists." % f)
+                continue
 
             try:
                 try:
-                    video = video_loader.Video(f)
+                    video = video_loader.open_video(f, namespace.backend)
                 except ValueError:
                     # The file stopped existing. Error.
                     raise IOError("Video stopped existing while opening.")
-                
-                global results
-                results = find_matches.scan_video(video, get_data_log(namespace))
+
+                if record is not None:
+                    timings = record.get_matches(f)
+                else:
+                    timings = None
+
+                if timings is not None:
+                    print("Already found the matches of %s." % video.name)
+                    results = None
+                else:
+                    if f in scans:
+                        results = scans.pop(f).get()
+                        # Refine with the same view as the workers.
+                        find_matches.scan_roi(video)
+                    else:
+                        # Picks up from the scan cache if it was stopped.
+                        results = find_matches.scan_video(
+                            video, get_data_log(namespace), executor)
+                    # Find the edges of the matches while the readers are
+                    # open.
+                    timings = find_matches.refine_matches(
+                        video, results, get_data_log(namespace), executor)
+                video.close()
 
                 video_loader.close_image()
                 # Write the results to file.
-                out_dir = namespace.target_dir
-                if not os.path.exists(out_dir):
-                    # Make the directory.
-                    os.mkdir(out_dir)
-                    logging.debug("Created folder %r" % out_dir)
-                    data_file = os.path.join(out_dir, MATCH_DATA_FILE)
-                elif os.path.isdir(out_dir):
-                    # Then store the file at "match_results.json"
-                    data_file = os.path.join(out_dir, MATCH_DATA_FILE)
+                if len(videos) > 1 and os.path.isdir(out_dir):
+                    video_dir = os.path.join(
+                        out_dir, os.path.splitext(video.name)[0])
+                    if not os.path.exists(video_dir):
+                        os.mkdir(video_dir)
                 else:
-                    data_file = None
-                if data_file:
+                    video_dir = out_dir
+                if results is not None and os.path.isdir(video_dir):
+                    # Then store the file at "match_results.json"
+                    data_file = os.path.join(video_dir, MATCH_DATA_FILE)
                     with open(data_file, "w") as out_file:
                         # Without other data, use str to serialize.
                         json.dump(results, out_file, default=str, indent=True)
+                if results is not None and record is not None:
+                    record.set_matches(f, timings)
+
+                # Now save videos.
+                writing.append(writer.call(
+                    find_matches.write_files, video, timings, video_dir,
+                    namespace.jobs, namespace.single_pass, record))
             finally:
                 video_loader.close_image()
     finally:
+        if scanner is not None:
+            scanner.terminate() # Only left running on an error.
+        if executor is not None:
+            executor.close()
+        if isinstance(namespace.data_log, scan_cache.Scan_Cache):
+            namespace.data_log.close()
         process_frames.deinit() # Close the threading even on error.
-
-    # Finished Processing!
-    # Now save videos.
-    timings = find_matches.time_video(results)
-    find_matches.write_files(video, timings, out_dir)
-
-parser_parse.add_argument("-d", "--data-log", type = PathType(exists = None))
+        # Let the clips being cut finish.
+        writer.close()
+
+    # Raise anything that went wrong cutting.
+    for future in writing:
+        future.result()
+
+parser_parse.add_argument("-d", "--data-log", type = PathType(exists = None),
+                          help = "Scan cache of the frames already read. "
+                          "Default is %s in the target folder."
+                          % scan_cache.SCAN_CACHE_FILE)
+parser_parse.add_argument("-w", "--workers", type = int, default = 0, help =
+                          "Number of processes to read frames with. "
+                          "Default 0 reads them in this process.")
+parser_parse.add_argument("-p", "--processes", type = int, default = 0,
+                          help = "Scan each video in parts on this many "
+                          "processes. Default 0 scans it in this process.")
+parser_parse.add_argument("-j", "--jobs", type = int, default = None,
+                          help = "Number of clips to cut at once. "
+                          "(Default %d)." % ffmpeg_pool.FFMPEG_JOBS)
+parser_parse.add_argument("--single-pass", action = "store_true",
+                          default = False, help = "Cut all the clips with "
+                          "one ffmpeg that reads the video once.")
 parser_parse.set_defaults(operation = parse)
 
 del parser_parse # No need to keep varible.
@@ -456,37 +571,192 @@ def finish(namespace):
     # 2) Build the intro graphic, pipe it to a named stream.
     # 3) Concat the two videos together and write out to disk.
 
+    # The record of what was finished before.
+    record = manifest.Manifest(folder)
+
+    jobs = []
     for f in filtered_files:
         # TO make output file, get basename from f and put it on target_dir
         basename = os.path.basename(f)
         out_file = os.path.join(namespace.target_dir, basename)
+        if record.is_finished(out_file):
+            print("Already finished %s." % out_file)
+            continue
 
         # Also the text in the box is the name of the original video.
         text, _ = os.path.splitext(basename)
 
-        command = ffmpeg_command(text, 'Video Intro.mov', f, out_file)
-
-        logging.debug(subprocess.list2cmdline(command))
-
-        process = subprocess.Popen(command, stderr = subprocess.PIPE)
-
-        # Monitor the process as it runs.
-        while process.poll() is None:
-            x = process.stderr.readline()
-            if x:
-                logging.debug("ffmepg:%r" % x.decode(errors='replace').rstrip('\n'))
-            else:
-                time.sleep(.1)
-        x = process.stderr.readline()
-        if x: logging.debug("ffmepg:%r" % x.decode(errors='replace').rstrip('\n'))
-
-        logging.debug("ffmpeg exited with status %d." % process.poll())
-
-        if process.poll() != 0:
-            logging.error("ffmpeg failed with status %d." % process.poll())
-
+        # If the intro can't be joined on, encode everything.
+        fallback = ffmpeg_command(text, 'Video Intro.mov', f, out_file)
+        jobs.append((text, f, out_file, fallback))
+
+    # Run a few at once and show how far each one is.
+    shown = {}
+    def progress(label, report):
+        now = time.time()
+        if report.get("progress") != "end" and \
+           now - shown.get(label, 0) < FINISH_PROGRESS_INTERVAL:
+            return
+        shown[label] = now
+        print("%s: %s at %s" % (label, report.get("out_time", "?"),
+                                report.get("speed", "?").strip()))
+
+    # The title cards are rendered once and kept with the output.
+    cache = intro_cache.Intro_Cache(
+        os.path.join(folder, intro_cache.INTRO_CACHE_DIR), 'Video Intro.mov')
+
+    def recorded(results):
+        """Mark each video as soon as it is finished."""
+        for result in results:
+            if result.status == 0:
+                record.finish_done(*sources[result.label])
+            yield result
+
+    sources = dict((text, (f, out_file)) for text, f, out_file, _ in jobs)
+    with ffmpeg_pool.FFmpeg_Pool(namespace.jobs) as pool:
+        ffmpeg_pool.report(recorded(pool.results(
+            [pool.call(intro_cache.finish_clip, cache, text, f, out_file,
+                       fallback, progress)
+             for text, f, out_file, fallback in jobs])))
+
+FINISH_PROGRESS_INTERVAL = 10 # Seconds between progress lines for a job.
+
+parser_finish.add_argument("-j", "--jobs", type = int, default = None,
+                           help = "Number of videos to finish at once. "
+                           "(Default %d)." % ffmpeg_pool.FFMPEG_JOBS)
 parser_finish.set_defaults(operation = finish)
 del parser_finish # No need to keep varible.
+##################################### Watch ####################################
+parser_watch = subparsers.add_parser("watch", help =
+    "Follow folder(s) the recorder writes into and cut matches as they end.")
+
+WATCH_FINISHED_DIR = "Finished" # Folder in target_dir for --finish.
+
+def watch(namespace):
+    """Watch operation for spaceraid.
+       source_files are folders. The videos in them are followed with
+       find_matches.stream_matches as they grow and each match is cut (and
+       finished with --finish) as soon as its end is known.
+       Each video gets a folder in target_dir, like parse with many videos.
+    """
+    out_dir = namespace.target_dir
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    record = manifest.Manifest(out_dir)
+    intros = intro_cache.Intro_Cache(
+        os.path.join(out_dir, intro_cache.INTRO_CACHE_DIR), 'Video Intro.mov')
+    folder_watcher = watcher.Folder_Watcher(
+        [f for f in namespace.source_files if os.path.isdir(f)],
+        namespace.poll)
+    streams = {} # path -> (stream_matches generator, its state)
+    # Clips are finished on these threads while the folders are followed.
+    finisher = ffmpeg_pool.FFmpeg_Pool(namespace.jobs)
+    finishing = []
+    try:
+        process_frames.init()
+        for path, complete in folder_watcher.changes(namespace.idle_exit):
+            if not path.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            if path not in streams:
+                if record.get_matches(path) is not None:
+                    continue # Already parsed.
+                state = {"complete": False, "start": None, "timings": []}
+                streams[path] = find_matches.stream_matches(
+                    path, namespace.backend, get_data_log(namespace),
+                    done = lambda state = state: state["complete"],
+                    poll = False), state
+            matches, state = streams[path]
+            state["complete"] = complete
+
+            # Take the events until the stream has to wait for more video.
+            timings = []
+            for event in matches:
+                if event is None:
+                    break
+                print("%s: %s %s at %.1fs." %
+                      (os.path.basename(path), event.name, event.kind,
+                       event.time))
+                if event.kind == "start":
+                    state["start"] = event.time
+                else:
+                    timings.append((event.name, state["start"], event.time))
+            else:
+                # The video is complete, don't scan again.
+                del streams[path]
+            video_loader.close_image()
+
+            if timings:
+                state["timings"].extend(timings)
+                name = os.path.basename(path)
+                video_dir = os.path.join(out_dir, os.path.splitext(name)[0])
+                if not os.path.exists(video_dir):
+                    os.mkdir(video_dir)
+                find_matches.write_files(path, timings, video_dir,
+                                         namespace.jobs, record = record)
+                if namespace.finish:
+                    finishing.extend(finish_clips(
+                        finisher, intros, record, video_dir, timings,
+                        os.path.join(out_dir, WATCH_FINISHED_DIR)))
+            if path not in streams:
+                record.set_matches(path, state["timings"])
+    finally:
+        folder_watcher.close()
+        if isinstance(namespace.data_log, scan_cache.Scan_Cache):
+            namespace.data_log.close()
+        process_frames.deinit()
+        # Let the clips being finished finish.
+        finisher.close()
+
+    # Raise anything that went wrong finishing.
+    for future in finishing:
+        future.result()
+
+def finish_clips(pool, intros, record, video_dir, timings, folder):
+    """Finish the clips of timings (in video_dir) into folder, like finish,
+       on pool (an ffmpeg_pool.FFmpeg_Pool). Each is marked in record when
+       it is done. Returns the futures of their Job_Results."""
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    futures = []
+    for match_name, start_time, stop_time in timings:
+        text = str(match_name)
+        clip = os.path.join(video_dir, text + ".mp4")
+        out_file = os.path.join(folder, os.path.basename(clip))
+        if not os.path.exists(clip) or record.is_finished(out_file):
+            continue
+        futures.append(pool.call(_finish_clip, intros, record, text, clip,
+                                 out_file))
+    return futures
+
+def _finish_clip(intros, record, text, clip, out_file):
+    """Finish one clip for finish_clips."""
+    result = intro_cache.finish_clip(
+        intros, text, clip, out_file,
+        ffmpeg_command(text, 'Video Intro.mov', clip, out_file))
+    print("Finished %s in %.1fs with status %s" %
+          (text, result.seconds, result.status))
+    if result.status == 0:
+        record.finish_done(clip, out_file)
+    return result
+
+parser_watch.add_argument("-d", "--data-log", type = PathType(exists = None),
+                          help = "Scan cache of the frames already read. "
+                          "Default is %s in the target folder."
+                          % scan_cache.SCAN_CACHE_FILE)
+parser_watch.add_argument("-j", "--jobs", type = int, default = None,
+                          help = "Number of clips to cut at once. "
+                          "(Default %d)." % ffmpeg_pool.FFMPEG_JOBS)
+parser_watch.add_argument("-f", "--finish", action = "store_true",
+                          default = False, help = "Also finish each clip "
+                          "into %s in the target folder." % WATCH_FINISHED_DIR)
+parser_watch.add_argument("--poll", type = float, default = None,
+                          help = "Seconds between looks at the folders. "
+                          "(Default %s)." % watcher.WATCH_POLL)
+parser_watch.add_argument("--idle-exit", type = float, default = None,
+                          help = "Stop after this many seconds without a "
+                          "change. Default is to run until stopped.")
+parser_watch.set_defaults(operation = watch)
+del parser_watch # No need to keep varible.
 ##################################### Run ######################################
 parser_upload=subparsers.add_parser("upload",help="Upload the file to youtube.")
 
@@ -638,8 +908,9 @@ del parser_test
 # argparse.py   581 Compared eq + to      + (True).
 
 parser.add_argument('source_files',nargs=1,action ="append",
-                    type=PathType(dash_ok=False), # Turns out opencv won't do -.
-                    help = "Video file to analyze.")
+                    # Turns out opencv won't do -.
+                    type=PathType(type=None, dash_ok=False),
+                    help = "Video file (or folder of them) to analyze.")
 # All this fuss, for this one line.
 
 parser.add_argument('target_dir',type=PathType(type=('dir','file').__contains__,
@@ -647,11 +918,21 @@ parser.add_argument('target_dir',type=PathType(type=('dir','file').__contains__,
                     help = "Output folder for processed videos.")
 
 def get_data_log(namespace):
-    """Open the data log if it is not already."""
+    """Open the scan cache if it is not already.
+       By default it is scan_cache.SCAN_CACHE_FILE in the target folder."""
+    if namespace.data_log is None:
+        target_dir = getattr(namespace, "target_dir", None)
+        if target_dir is None:
+            return None
+        if not os.path.exists(target_dir):
+            os.mkdir(target_dir)
+            logging.debug("Created folder %r" % target_dir)
+        elif not os.path.isdir(target_dir):
+            return None # Nowhere to keep it.
+        namespace.data_log = os.path.join(target_dir,
+                                          scan_cache.SCAN_CACHE_FILE)
     if isinstance(namespace.data_log, str):
-        namespace.data_log = open(namespace.data_log, "a+", buffering = 1)
-
-        namespace.data_log.seek(0)
+        namespace.data_log = scan_cache.Scan_Cache(namespace.data_log)
     return namespace.data_log
 
 def main(args = None):
@@ -6,7 +6,12 @@ DEBUG   If this value is set to true, and handful of files will be created
         with parts of the picture as it is processed.
 
 extract_image(img)  Inspect Image and convert it to a format that is easier for
-        tesseract to process. This function is NOT thread safe.
+        tesseract to process. This function is thread safe, each call keeps
+        its state on its own Extractor.
+
+stress_test(img)    Check extract_image gives the same result from many threads.
+
+benchmark()         Time extract_image on noisy crops of a few sizes.
 """
 #Matthew Schweiss source from "raw.githubusercontent.com/jasonlfunk/ocr-text-extraction/master/extract_text"
 
@@ -45,19 +50,6 @@ __author__ = "Jason Funk" # 2012, jasonlfunk@gmail.com
 __version__ = "1.0"
 DEBUG = 0
 
-# Determine pixel intensity
-# Apparently human eyes register colors differently.
-# TVs use this formula to determine
-# pixel intensity = 0.30R + 0.59G + 0.11B
-def ii(xx, yy):
-    global img, img_y, img_x
-    if yy >= img_y or xx >= img_x:
-        #print "pixel out of bounds ("+str(y)+","+str(x)+")"
-        return 0
-    pixel = img[yy][xx]
-    return 0.30 * pixel[2] + 0.59 * pixel[1] + 0.11 * pixel[0]
-
-
 # A quick test to check whether the contour is
 # a connected shape
 def connected(contour):
@@ -66,270 +58,384 @@ def connected(contour):
     return abs(first[0] - last[0]) <= 1 and abs(first[1] - last[1]) <= 1
 
 
-# Helper function to return a given contour
-def c(index):
-    global contours
-    return contours[index]
-
-
-# Count the number of real children
-def count_children(index, h_, contour):
-    # No children
-    if h_[index][2] < 0:
-        return 0
-    else:
-        #If the first child is a contour we care about
-        # then count it, otherwise don't
-        if keep(c(h_[index][2])):
-            count = 1
-        else:
-            count = 0
-
-            # Also count all of the child's siblings and their children
-        count += count_siblings(h_[index][2], h_, contour, True)
-        return count
-
-
-# Quick check to test if the contour is a child
-def is_child(index, h_):
-    return get_parent(index, h_) > 0
-
-
-# Get the first parent of the contour that we care about
-def get_parent(index, h_):
-    parent = h_[index][3]
-    while not keep(c(parent)) and parent > 0:
-        parent = h_[parent][3]
-
-    return parent
-
-# Count the number of relevant siblings of a contour
-def count_siblings(index, h_, contour, inc_children=False):
-    # Include the children if necessary
-    if inc_children:
-        count = count_children(index, h_, contour)
-    else:
-        count = 0
-
-    # Look ahead
-    p_ = h_[index][0]
-    while p_ > 0:
-        if keep(c(p_)):
-            count += 1
-        if inc_children:
-            count += count_children(p_, h_, contour)
-        p_ = h_[p_][0]
-
-    # Look behind
-    n = h_[index][1]
-    while n > 0:
-        if keep(c(n)):
-            count += 1
-        if inc_children:
-            count += count_children(n, h_, contour)
-        n = h_[n][1]
-    return count
-
-
-# Whether we care about this contour
-def keep(contour):
-    return keep_box(contour) and connected(contour)
-
-# Whether we should keep the containing box of this
-# contour based on it's shape
-def keep_box(contour):
-    global img_x, img_y
-    xx, yy, w_, h_ = cv2.boundingRect(contour)
-
-    # width and height need to be floats
-    w_ *= 1.0
-    h_ *= 1.0
-
-    # Test it's shape - if it's too oblong or tall it's
-    # probably not a real character
-    if w_ / h_ < 0.1 or w_ / h_ > 10:
-        if DEBUG:
-            print("\t Rejected because of shape: (" + str(xx) + "," + str(yy) + "," + str(w_) + "," + str(h_) + ")" + \
-                  str(w_ / h_))
-        return False
-    
-    # check size of the box
-    if ((w_ * h_) > ((img_x * img_y) / 5)) or ((w_ * h_) < 15):
-        if DEBUG:
-            print("\t Rejected because of size")
-        return False
-
-    return True
-
+def luma_at(luma, xs, ys):
+    """Get the intensities from the luma plane at the points xs, ys, the
+       same as Extractor.ii() does for each point, 0 past the bottom or right
+       of the image."""
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    inside = (ys < luma.shape[0]) & (xs < luma.shape[1])
+    values = np.zeros(xs.shape)
+    values[inside] = luma[ys[inside], xs[inside]]
+    return values
+
+
+class Extractor(object):
+    """Extractor(orig_img, DEBUG = DEBUG).extract()
+       All of the state of one extraction (the bordered image, its size and
+       its contours) lives on the Extractor instead of in module globals, so
+       any number of extractions can run at once on different threads.
+    """
+    def __init__(self, orig_img, DEBUG = DEBUG):
+        self.debug = DEBUG
+        # Add a border to the image for processing sake
+        self.img = cv2.copyMakeBorder(orig_img, 50, 50, 50, 50,
+                                      cv2.BORDER_CONSTANT)
+
+        # Calculate the width and height of the image
+        self.img_y = len(self.img)
+        self.img_x = len(self.img[0])
+        self.contours = None
+
+    # Determine pixel intensity
+    # Apparently human eyes register colors differently.
+    # TVs use this formula to determine
+    # pixel intensity = 0.30R + 0.59G + 0.11B
+    def ii(self, xx, yy):
+        if yy >= self.img_y or xx >= self.img_x:
+            #print "pixel out of bounds ("+str(y)+","+str(x)+")"
+            return 0
+        pixel = self.img[yy][xx]
+        return 0.30 * pixel[2] + 0.59 * pixel[1] + 0.11 * pixel[0]
+
+    # Helper function to return a given contour
+    def c(self, index):
+        return self.contours[index]
+
+    # The contour tree.
+    # Whether a contour is kept depends on how many kept contours are inside
+    # it and inside its nearest kept parent. Walking the tree for each
+    # contour visits the same contours (and recomputes their bounding boxes)
+    # over and over, so analyze() works out everything once, in one pass.
+    def analyze(self, h_):
+        """Work out for every contour, once: its bounding rect (rects),
+           whether we care about it (kept), its nearest kept parent
+           (kept_parent) and how many kept contours are inside it
+           (kept_children)."""
+        contours = self.contours
+        count = len(contours)
+        self.rects = [cv2.boundingRect(contour) for contour in contours]
+        self.kept = [self.keep_box(contour, rect) and connected(contour)
+                     for contour, rect in zip(contours, self.rects)]
+        kept = self.kept
+
+        # The children of each contour. Starting from the first child, look
+        # ahead then behind through its siblings. (Index 0 ends a walk.)
+        children = [[] for index in range(count)]
+        for index in range(count):
+            first = h_[index][2]
+            if first < 0:
+                continue
+            kids = children[index]
+            kids.append(first)
+            p_ = h_[first][0]
+            while p_ > 0:
+                kids.append(p_)
+                p_ = h_[p_][0]
+            n = h_[first][1]
+            while n > 0:
+                kids.append(n)
+                n = h_[n][1]
+
+        # Count the kept contours inside each contour, children before
+        # parents, without recursion.
+        kept_children = [None] * count
+        for root in range(count):
+            if kept_children[root] is not None:
+                continue
+            stack = [(root, False)]
+            while stack:
+                index, ready = stack.pop()
+                if ready:
+                    kept_children[index] = sum(kept[kid] + kept_children[kid]
+                                               for kid in children[index])
+                elif kept_children[index] is None:
+                    stack.append((index, True))
+                    stack.extend((kid, False) for kid in children[index]
+                                 if kept_children[kid] is None)
+        self.kept_children = kept_children
+
+        # The first parent we care about. Going up stops at a kept contour
+        # or at index 0 or less. Every contour passed on the way up gets the
+        # same answer, so remember it for them too.
+        found = {}
+        def walk(parent):
+            passed = []
+            while parent > 0 and not kept[parent] and parent not in found:
+                passed.append(parent)
+                parent = h_[parent][3]
+            if parent > 0 and not kept[parent]:
+                parent = found[parent]
+            for index in passed:
+                found[index] = parent
+            return parent
+        self.kept_parent = [walk(h_[index][3]) for index in range(count)]
+
+    # Count the number of real children
+    def count_children(self, index):
+        return self.kept_children[index]
+
+    # Quick check to test if the contour is a child
+    def is_child(self, index):
+        return self.get_parent(index) > 0
+
+    # Get the first parent of the contour that we care about
+    def get_parent(self, index):
+        return self.kept_parent[index]
+
+    # Whether we care about this contour
+    def keep(self, contour):
+        return self.keep_box(contour) and connected(contour)
+
+    # Whether we should keep the containing box of this
+    # contour based on it's shape
+    def keep_box(self, contour, rect = None):
+        if rect is None:
+            rect = cv2.boundingRect(contour)
+        xx, yy, w_, h_ = rect
+
+        # width and height need to be floats
+        w_ *= 1.0
+        h_ *= 1.0
+
+        # Test it's shape - if it's too oblong or tall it's
+        # probably not a real character
+        if w_ / h_ < 0.1 or w_ / h_ > 10:
+            if self.debug:
+                print("\t Rejected because of shape: (" + str(xx) + "," + str(yy) + "," + str(w_) + "," + str(h_) + ")" + \
+                      str(w_ / h_))
+            return False
+
+        # check size of the box
+        if ((w_ * h_) > ((self.img_x * self.img_y) / 5)) or ((w_ * h_) < 15):
+            if self.debug:
+                print("\t Rejected because of size")
+            return False
+
+        return True
+
+    def include_box(self, index):
+        if self.debug:
+            print(str(index) + ":")
+            if self.is_child(index):
+                print("\tIs a child")
+                print("\tparent " + str(self.get_parent(index)) + " has " + str(
+                    self.count_children(self.get_parent(index))) + " children")
+                print("\thas " + str(self.count_children(index)) + " children")
+
+        if self.is_child(index) and \
+           self.count_children(self.get_parent(index)) <= 2:
+            if self.debug:
+                print("\t skipping: is an interior to a letter")
+            return False
+
+        if self.count_children(index) > 2:
+            if self.debug:
+                print("\t skipping, is a container of letters")
+            return False
+
+        if self.debug:
+            print("\t keeping")
+        return True
+
+    def extract(self):
+        """Pre-Process the image for the tesseract ocr."""
+        DEBUG = self.debug
+        img, img_x, img_y = self.img, self.img_x, self.img_y
+
+        # The intensity of every pixel at once, the same as ii() gives.
+        luma = self.luma = 0.30 * img[..., 2] + 0.59 * img[..., 1] + \
+                           0.11 * img[..., 0]
 
-def include_box(index, h_, contour):
-    if DEBUG:
-        print(str(index) + ":")
-        if is_child(index, h_):
-            print("\tIs a child")
-            print("\tparent " + str(get_parent(index, h_)) + " has " + str(
-                count_children(get_parent(index, h_), h_, contour)) + " children")
-            print("\thas " + str(count_children(index, h_, contour)) + " children")
-
-    if is_child(index, h_) and count_children(get_parent(index, h_), h_, contour) <= 2:
-        if DEBUG:
-            print("\t skipping: is an interior to a letter")
-        return False
-
-    if count_children(index, h_, contour) > 2:
         if DEBUG:
-            print("\t skipping, is a container of letters")
-        return False
-
-    if DEBUG:
-        print("\t keeping")
-    return True
-
-def extract_image(orig_img, DEBUG = DEBUG):
-    """Pre-Process the image for the tesseract ocr."""
-    global img, img_x, img_y, contours
-    # Add a border to the image for processing sake
-    img = cv2.copyMakeBorder(orig_img, 50, 50, 50, 50, cv2.BORDER_CONSTANT)
-
-    # Calculate the width and height of the image
-    img_y = len(img)
-    img_x = len(img[0])
-
-    if DEBUG:
-        print("Image is " + str(len(img)) + "x" + str(len(img[0])))
-
-    #Split out each channel
-    blue, green, red = cv2.split(img)
-
-    # Run canny edge detection on each channel
-    blue_edges = cv2.Canny(blue, 200, 250)
-    green_edges = cv2.Canny(green, 200, 250)
-    red_edges = cv2.Canny(red, 200, 250)
+            print("Image is " + str(len(img)) + "x" + str(len(img[0])))
 
-    # Join edges back into image
-    edges = blue_edges | green_edges | red_edges
+        #Split out each channel
+        blue, green, red = cv2.split(img)
 
-    # Find the contours
-    result = cv2.findContours(edges.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-    contours, hierarchy = result if len(result) == 2 else result[1:3]
-    hierarchy = hierarchy[0]
+        # Run canny edge detection on each channel
+        blue_edges = cv2.Canny(blue, 200, 250)
+        green_edges = cv2.Canny(green, 200, 250)
+        red_edges = cv2.Canny(red, 200, 250)
 
-    if DEBUG:
-        processed = edges.copy()
-        rejected = edges.copy()
+        # Join edges back into image
+        edges = blue_edges | green_edges | red_edges
 
-    # These are the boxes that we are determining
-    keepers = []
+        # Find the contours
+        result = cv2.findContours(edges.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+        contours, hierarchy = result if len(result) == 2 else result[1:3]
+        self.contours = contours
+        hierarchy = hierarchy[0]
+        self.analyze(hierarchy)
 
-    # For each contour, find the bounding rectangle and decide
-    # if it's one we care about
-    for index_, contour_ in enumerate(contours):
         if DEBUG:
-            print("Processing #%d" % index_)
+            processed = edges.copy()
+            rejected = edges.copy()
 
-        x, y, w, h = cv2.boundingRect(contour_)
+        # These are the boxes that we are determining
+        keepers = []
 
-        # Check the contour and it's bounding box
-        if keep(contour_) and include_box(index_, hierarchy, contour_):
-            # It's a winner!
-            keepers.append([contour_, [x, y, w, h]])
+        # For each contour, find the bounding rectangle and decide
+        # if it's one we care about
+        for index_, contour_ in enumerate(contours):
             if DEBUG:
-                cv2.rectangle(processed, (x, y), (x + w, y + h), (100, 100, 100), 1)
-                cv2.putText(processed, str(index_), (x, y - 5), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
-        else:
+                print("Processing #%d" % index_)
+
+            x, y, w, h = self.rects[index_]
+
+            # Check the contour and it's bounding box
+            if self.kept[index_] and self.include_box(index_):
+                # It's a winner!
+                keepers.append([contour_, [x, y, w, h]])
+                if DEBUG:
+                    cv2.rectangle(processed, (x, y), (x + w, y + h), (100, 100, 100), 1)
+                    cv2.putText(processed, str(index_), (x, y - 5), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
+            else:
+                if DEBUG:
+                    cv2.rectangle(rejected, (x, y), (x + w, y + h), (100, 100, 100), 1)
+                    cv2.putText(rejected, str(index_), (x, y - 5), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
+
+        # Make a white copy of our image
+        new_image = edges.copy()
+        new_image.fill(255)
+        boxes = []
+
+        # For each box, find the foreground and background intensities
+        for index_, (contour_, box) in enumerate(keepers):
+
+            # Find the average intensity of the edge pixels to
+            # determine the foreground intensity
+            # (cumsum adds in order, exactly like adding them one by one.)
+            points = contour_[:, 0]
+            fg_int = 0.0 + np.cumsum(luma_at(luma, points[:, 0],
+                                             points[:, 1]))[-1]
+
+            fg_int /= len(contour_)
             if DEBUG:
-                cv2.rectangle(rejected, (x, y), (x + w, y + h), (100, 100, 100), 1)
-                cv2.putText(rejected, str(index_), (x, y - 5), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
+                print("FG Intensity for #%d = %d" % (index_, fg_int))
+
+            # Find the intensity of three pixels going around the
+            # outside of each corner of the bounding box to determine
+            # the background intensity
+            x_, y_, width, height = box
+            bg_int = luma_at(luma,
+                [
+                    # bottom left corner 3 pixels
+                    x_ - 1, x_ - 1, x_,
+                    # bottom right corner 3 pixels
+                    x_ + width + 1, x_ + width, x_ + width + 1,
+                    # top left corner 3 pixels
+                    x_ - 1, x_ - 1, x_,
+                    # top right corner 3 pixels
+                    x_ + width + 1, x_ + width, x_ + width + 1
+                ],
+                [
+                    y_ - 1, y_, y_ - 1,
+                    y_ - 1, y_ - 1, y_,
+                    y_ + height + 1, y_ + height, y_ + height + 1,
+                    y_ + height + 1, y_ + height + 1, y_ + height
+                ])
+
+            # Find the median of the background
+            # pixels determined above
+            bg_int = np.median(bg_int)
 
-    # Make a white copy of our image
-    new_image = edges.copy()
-    new_image.fill(255)
-    boxes = []
-
-    # For each box, find the foreground and background intensities
-    for index_, (contour_, box) in enumerate(keepers):
-
-        # Find the average intensity of the edge pixels to
-        # determine the foreground intensity
-        fg_int = 0.0
-        for p in contour_:
-            fg_int += ii(p[0][0], p[0][1])
-
-        fg_int /= len(contour_)
-        if DEBUG:
-            print("FG Intensity for #%d = %d" % (index_, fg_int))
-
-        # Find the intensity of three pixels going around the
-        # outside of each corner of the bounding box to determine
-        # the background intensity
-        x_, y_, width, height = box
-        bg_int = \
-            [
-                # bottom left corner 3 pixels
-                ii(x_ - 1, y_ - 1),
-                ii(x_ - 1, y_),
-                ii(x_, y_ - 1),
-
-                # bottom right corner 3 pixels
-                ii(x_ + width + 1, y_ - 1),
-                ii(x_ + width, y_ - 1),
-                ii(x_ + width + 1, y_),
-
-                # top left corner 3 pixels
-                ii(x_ - 1, y_ + height + 1),
-                ii(x_ - 1, y_ + height),
-                ii(x_, y_ + height + 1),
-
-                # top right corner 3 pixels
-                ii(x_ + width + 1, y_ + height + 1),
-                ii(x_ + width, y_ + height + 1),
-                ii(x_ + width + 1, y_ + height)
-            ]
-
-        # Find the median of the background
-        # pixels determined above
-        bg_int = np.median(bg_int)
+            if DEBUG:
+                print("BG Intensity for #%d = %s" % (index_, repr(bg_int)))
+
+            # Determine if the box should be inverted
+            if fg_int >= bg_int:
+                fg = 255
+                bg = 0
+            else:
+                fg = 0
+                bg = 255
+
+            # Color every pixel in the box at once, brighter than the
+            # foreground is background. Slicing drops any part of the box
+            # that is out of bounds.
+            if DEBUG and (x_ + width > img_x or y_ + height > img_y):
+                print("box #%d is partly out of bounds" % index_)
+            new_image[y_ : y_ + height, x_ : x_ + width] = np.where(
+                luma[y_ : y_ + height, x_ : x_ + width] > fg_int, bg, fg)
+
+        # blur a bit to improve ocr accuracy
+        new_image = cv2.blur(new_image, (2, 2))
 
         if DEBUG:
-            print("BG Intensity for #%d = %s" % (index_, repr(bg_int)))
-
-        # Determine if the box should be inverted
-        if fg_int >= bg_int:
-            fg = 255
-            bg = 0
-        else:
-            fg = 0
-            bg = 255
-
-            # Loop through every pixel in the box and color the
-            # pixel accordingly
-        for x in range(x_, x_ + width):
-            for y in range(y_, y_ + height):
-                if y >= img_y or x >= img_x:
-                    if DEBUG:
-                        print("pixel out of bounds (%d,%d)" % (y, x))
-                    continue
-                if ii(x, y) > fg_int:
-                    new_image[y][x] = bg
-                else:
-                    new_image[y][x] = fg
-
-    # blur a bit to improve ocr accuracy
-    new_image = cv2.blur(new_image, (2, 2))
-
-    if DEBUG:
-        cv2.imwrite('edges.png', edges)
-        cv2.imwrite('processed.png', processed)
-        cv2.imwrite('rejected.png', rejected)
+            cv2.imwrite('edges.png', edges)
+            cv2.imwrite('processed.png', processed)
+            cv2.imwrite('rejected.png', rejected)
         
-    return new_image
+        return new_image
+
+def extract_image(orig_img, DEBUG = DEBUG):
+    """Pre-Process the image for the tesseract ocr.
+       Safe to call from several threads at once."""
+    return Extractor(orig_img, DEBUG).extract()
+
+def stress_test(orig_img, threads = 8, rounds = 25):
+    """Run extract_image on orig_img from many threads at once and check
+       every result is identical to a plain single threaded run.
+       Returns the number of results that differed."""
+    import threading
+    expected = extract_image(orig_img)
+    failures = [0]
+    lock = threading.Lock()
+
+    def work():
+        for i in range(rounds):
+            if not np.array_equal(extract_image(orig_img), expected):
+                with lock:
+                    failures[0] += 1
+
+    workers = [threading.Thread(target = work) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    print("%d of %d threaded extractions differed." %
+          (failures[0], threads * rounds))
+    return failures[0]
+
+def benchmark(sizes = ((28, 13), (56, 26), (112, 52), (224, 104)),
+              repeat = 20):
+    """Time extract_image on random noise crops of each (width, height).
+       Noise makes a great many contours, the worst case for the contour
+       tree. Prints the contour count and the time per crop for each size.
+    """
+    import time
+    random = np.random.RandomState(0) # The same crops every time.
+    for width, height in sizes:
+        crop = random.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        extractor = Extractor(crop)
+        start = time.time()
+        for i in range(repeat):
+            extractor = Extractor(crop)
+            extractor.extract()
+        elapsed = (time.time() - start) / repeat
+        print("%4dx%-4d %6d contours %9.2f ms" %
+              (width, height, len(extractor.contours), elapsed * 1000))
 
 def main(args=None):
     if args is None:
         args = sys.argv
         
+    if len(args) == 2 and args[1] == "--benchmark":
+        benchmark()
+        sys.exit()
+
+    if len(args) == 3 and args[1] == "--stress":
+        # Check that extraction is thread safe on this image.
+        if not os.path.isfile(args[2]):
+            print("No such file '%s'" % args[2])
+            sys.exit()
+        sys.exit(1 if stress_test(cv2.imread(args[2])) else 0)
+
     if len(args) != 3:
         print("%s input_file output_file" % args[0])
+        print("%s --stress input_file" % args[0])
+        print("%s --benchmark" % args[0])
         sys.exit()
     else:
         input_file = args[1]
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Run ffmpeg commands a few at a time.
+
+Each command runs on a thread of its own that reads its stderr as it comes,
+so no ffmpeg ever stalls on a full pipe and nothing polls with sleeps. At
+most jobs commands run at once.
+
+FFmpeg_Pool(jobs)      Pool of ffmpeg processes.
+Job_Result             How one command went.
+run_command            Run one command and wait for it.
+report                 Print how the jobs went.
+media_seconds          Seconds of output in a -progress report.
+"""
+import time
+import logging
+import threading
+import subprocess
+
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+__all__ = ["FFmpeg_Pool", "Job_Result", "run_command", "report",
+           "media_seconds", "FFMPEG_JOBS"]
+
+FFMPEG_JOBS = 4 # Stream copies wait on the disk, so a few overlap well.
+FFMPEG_TAIL = 20 # Lines of stderr kept for each job.
+
+Job_Result = namedtuple("Job_Result", ["label", "command", "status",
+                                       "seconds", "output", "progress"])
+Job_Result.__doc__ = """Job_Result(label, command, status, seconds, output,
+                                   progress)
+       status is the exit status of ffmpeg, seconds how long it ran and
+       output the last FFMPEG_TAIL lines of stderr. progress is the last
+       -progress report (see run_command), or {}."""
+
+def _drain(stream, label, tail):
+    """Log each line of stream (a stderr) and keep the last ones in tail."""
+    for line in stream:
+        line = line.decode(errors = 'replace').rstrip('\n')
+        tail.append(line)
+        logging.debug("ffmpeg %s: %s" % (label, line))
+    stream.close()
+
+def media_seconds(progress):
+    """How many seconds of output a -progress report is at, or None."""
+    for key, scale in (("out_time_us", 1e-6), ("out_time_ms", 1e-6)):
+        try:
+            return int(progress[key]) * scale # out_time_ms is in us too.
+        except (KeyError, ValueError):
+            pass
+    return None
+
+def run_command(label, command, progress = None):
+    """Run command, logging its stderr, and return a Job_Result.
+       If progress is given, ffmpeg is asked for -progress reports and
+       progress(label, report) is called with each one, a dict of its
+       key=value lines (out_time_us, fps, speed, progress, ...).
+    """
+    if progress is not None:
+        command = command[:1] + ['-progress', 'pipe:1'] + command[1:]
+    logging.debug("ffmpeg %s: %s" % (label, subprocess.list2cmdline(command)))
+    start = time.time()
+    tail = deque(maxlen = FFMPEG_TAIL)
+    try:
+        process = subprocess.Popen(
+            command, stdin = subprocess.DEVNULL, stderr = subprocess.PIPE,
+            stdout = subprocess.DEVNULL if progress is None else subprocess.PIPE)
+    except OSError as error:
+        logging.error("Could not start ffmpeg for %s: %s" % (label, error))
+        return Job_Result(label, command, None, 0., [str(error)], {})
+
+    report = {}
+    if progress is None:
+        # Reading to the end drains the pipe as ffmpeg writes it.
+        _drain(process.stderr, label, tail)
+    else:
+        # stderr on its own thread, the reports here.
+        drain = threading.Thread(target = _drain,
+                                 args = (process.stderr, label, tail),
+                                 name = "ffmpeg %s stderr" % label)
+        drain.daemon = True
+        drain.start()
+        lines = {}
+        for line in process.stdout:
+            key, _, value = line.decode(errors = 'replace').strip().partition('=')
+            lines[key] = value
+            if key == "progress": # Last line of each report.
+                report = lines
+                lines = {}
+                progress(label, report)
+        process.stdout.close()
+        drain.join()
+    status = process.wait()
+
+    result = Job_Result(label, command, status, time.time() - start,
+                        list(tail), report)
+    if status != 0:
+        logging.error("ffmpeg failed on %s with status %d." % (label, status))
+    return result
+
+class FFmpeg_Pool(object):
+    """FFmpeg_Pool(jobs = FFMPEG_JOBS)
+       Run ffmpeg commands, at most jobs at once.
+    """
+    def __init__(self, jobs = None):
+        self.jobs = jobs or FFMPEG_JOBS
+        self.executor = ThreadPoolExecutor(self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, label, command, progress = None):
+        """Start command. Returns a future of its Job_Result.
+           progress is passed on to run_command."""
+        return self.executor.submit(run_command, label, command, progress)
+
+    def run(self, commands, progress = None):
+        """Run each (label, command) in commands.
+           Yields the Job_Results as the commands finish."""
+        return self.results([self.submit(label, command, progress)
+                             for label, command in commands])
+
+    def call(self, function, *args):
+        """Run function(*args) on the pool, for jobs of more than one
+           command. Returns a future of what it returns."""
+        return self.executor.submit(function, *args)
+
+    @staticmethod
+    def results(futures):
+        """Yield the results of futures as they finish."""
+        for future in as_completed(futures):
+            yield future.result()
+
+    def close(self):
+        """Wait for the commands and stop the threads."""
+        self.executor.shutdown(wait = True)
+
+def report(results):
+    """Print one line per Job_Result as they come and a total at the end.
+       Returns the list of results."""
+    done = []
+    start = time.time()
+    for result in results:
+        done.append(result)
+        print("Finished %s in %.1fs with status %s" %
+              (result.label, result.seconds, result.status))
+    elapsed = time.time() - start
+    failed = sum(1 for result in done if result.status != 0)
+    print("%d jobs in %.1fs (%.1fs of ffmpeg), %d failed." %
+          (len(done), elapsed, sum(result.seconds for result in done), failed))
+
+    # Throughput, when the jobs gave -progress reports.
+    media = [media_seconds(result.progress) for result in done]
+    media = sum(seconds for seconds in media if seconds)
+    if media and elapsed > 0:
+        print("Wrote %.1fs of video, %.2fx realtime, %.1f jobs per hour." %
+              (media, media / elapsed, len(done) * 3600. / elapsed))
+    return done
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 """Takes the video feed and looks for signs that a match is there."""
 import os
-import csv
 import sys
 import math
+from time import sleep, time as now # "time" is the timer reading below.
 import queue
 import logging
 import subprocess
+import multiprocessing
 
-from collections  import Counter # Counts frequency
+from collections  import Counter, deque, namedtuple # Counts frequency
 from terminalsize import get_terminal_size
 
+import scan_cache
+import ffmpeg_pool
 import video_loader
 import process_frames
 
@@ -71,49 +74,53 @@ def unique(items):
 
     return keep
 
-def read_moment(video, data_log = None):
+def moment_first(center):
+    """The first frame of the moment around frame center."""
+    return max(center - MOMENT_MINIMUM_FRAMES // 2, 0)
+
+def read_options(video):
+    """The options for read_image of frames from video. If the video only
+       gives the scoreboard, they tell read_image where it is."""
+    roi = video.get_roi()
+    if roi is None:
+        return {}
+    return {"frame_size": (video.get_frame_width(), video.get_frame_height()),
+            "offset"    : roi[:2]}
+
+def submit_moment(video, executor, center, frames, known):
+    """Hand the frames of the moment around center (the burst read there)
+       that are not in known to executor, without waiting for them.
+       Returns {frame number in the burst: result} for read_moment."""
+    first = moment_first(center)
+    options = read_options(video)
+    return dict((frame_number, executor.submit(frame, **options))
+                for frame_number, frame in enumerate(frames)
+                if first + frame_number not in known)
+
+def read_moment(video, cache = None, center = None, executor = None,
+                stream = None, info = None, name_only = False, frames = None,
+                known = None, submitted = None):
     """Read text at the frame number (frames from start of video).
 
-    If data_log is specified, it is a tsv file with data that has aleady been
-    processed from this video file. Cache file could also be blank.
+    If cache (a scan_cache.Scan_Cache) is given, frames that have been read
+    before are taken from it and new readings are stored in it. When every
+    frame needed is in the cache, the video is not even decoded.
+    center is the frame number to read around, the current frame by default.
+    If executor (a process_frames.Frame_Executor) is given, the frames are
+    read on its worker processes all at once. Otherwise stream (a
+    process_frames.Frame_Stream) skips the OCR of unchanged name boxes. It
+    is reset first, the frames before were not next to these.
+    If info (a dict) is given, info["frame"] is set to the last frame that
+    was decoded, None if everything came from the cache, and info["short"]
+    to whether the video gave fewer frames than were asked for.
+    With name_only, only the match (see same_match) is voted on and the time
+    returned is None. A timer tick or a misread total inside the moment then
+    does not split the vote, which is all that finding an edge needs.
+    frames is the burst around center if it was already read (see
+    Video.iter_sampled), and known what cache has from moment_first(center)
+    on if that was already looked up. submitted is what submit_moment gave
+    if the burst was already handed to executor.
     """
-    # First validate data_log is it exists.
-    if data_log is not None:
-        # This should be an object not a path.
-
-        # Try to check if the file is readable.
-        try:
-            readable = data_log.readable()
-        except AttributeError:
-            # Python 2, no "readable" attribute.
-            logging.debug("File object did not have a 'readable()' attribute.\n"
-                          "Normal for python 2.")
-
-            try:
-                data_log.read(0) # Try to read nothing, errors if can't read.
-            except IOError:
-                readable = False
-            else: # Successfully read.
-                readable = True
-
-        # Try to check if the file is writable.
-        try:
-            writable = data_log.writable()
-        except AttributeError:
-            # Python 2, no "writable" attribute.
-            logging.debug("File object did not have a 'writable()' attribute.\n"
-                          "Normal for python 2.")
-
-            try:
-                data_log.write("") # Try to write nothing, errors if can't write.
-            except IOError:
-                writable = False
-            else: # Successfully wrote.
-                writable = True
-    else:
-        # There is no data_log.
-        readable = writable = None
-
     # For different MOMENT_MINUMUM_FRAMES
     # 1: Take next frame.
     # 2: Take 1 previous frame and next 1.
@@ -122,73 +129,96 @@ def read_moment(video, data_log = None):
     # 5: Take 2 previous frames and next 3.
     #...
     moment = Counter() # Counter to put the frame results in.
+    voted = {} # With name_only, (match_type, match_number) -> a name.
 
-    # Set the video back MOMENT_MINIMUM_FRAMES // 2 frames.
-    frame_count = video.get_frame_index()
-
-    video.set_frame_index(frame_count - MOMENT_MINIMUM_FRAMES // 2)
+    if center is None:
+        center = int(video.get_frame_index())
 
-    # The frames that need to be analyized.
-    frames = [video.get_frame() for num in range(MOMENT_MINIMUM_FRAMES)]
+    # Read MOMENT_MINIMUM_FRAMES frames, starting MOMENT_MINIMUM_FRAMES // 2
+    # frames back, with one seek.
+    first = moment_first(center)
 
-    # Add the inital frames to the list.
-    for num in range(MOMENT_MINIMUM_FRAMES):
-        frames.append(video.get_frame())
+    # Look up everything this moment could need at once.
+    if known is None:
+        known = moment_known(video, cache, center)
 
-    if readable:
-        cache_reader = csv.reader(data_log)
+    # The frames that need to be analyized. More are added if some fail.
+    # A frame already in the cache is just None.
+    short = False
+    if frames is None and moment_cached(center, known):
+        frames = [None] * MOMENT_MINIMUM_FRAMES
+    else:
+        if frames is None:
+            frames = video.read_burst(center, MOMENT_MINIMUM_FRAMES)
+        frames = list(frames)
+        short = len(frames) < MOMENT_MINIMUM_FRAMES
+
+    roi_args = read_options(video)
+
+    if executor is None:
+        if stream is None:
+            stream = process_frames.Frame_Stream()
+        stream.reset()
+        read_image = stream.read_image
+        readings = {}
+    else:
+        read_image = executor.read_image
+        # Send the whole burst out to the workers at once.
+        if submitted is None:
+            submitted = submit_moment(video, executor, center, frames, known)
+        readings = dict((frame_number, result.get())
+                        for frame_number, result in submitted.items())
 
-    if writable:
-        cache_writer = csv.writer(data_log)
+    # New readings go to the cache together at the end, in one short write.
+    new_readings = {}
 
     # Now process the list.
-    for frame in frames:
-        if frame is None:
-            logging.error("frame is None")
-            continue
+    frame_number = 0
+    while frame_number < len(frames):
+        frame_index = first + frame_number
+        frame = frames[frame_number]
+        frame_number += 1
 
         # First, if there are cached results, use those.
-        if readable:
-            result = next(cache_reader, None)
-            if result is not None:
-                frame_index, match_type, match_number, total_matches, time = result
-
-                name = process_frames.Name_Result(match_type, match_number, total_matches)
-
-                if int(frame_index) != frame_count:
-                    logging.error("Data file sync failed with current readings.")
-                    readable = False # Readings did not match.
-                    writable = False # Don't write to a file that can't be synced.
+        if frame_index in known:
+            name, time = known[frame_index]
+        elif frame is None:
+            logging.error("frame is None")
+            continue
+        else:
+            if frame_index - first in readings:
+                name, time = readings[frame_index - first]
             else:
-                readable = None # Depleted, nothing else to read.
-
-        if not readable:
-            # Specifically written so if readable fails, this will catch.
-            name, time = process_frames.read_image(frame)
+                name, time = read_image(frame, **roi_args)
 
-            match_type = name.match_type
-            match_number = name.match_number
-            total_matches = name.total_matches
-
-            # Now save to file if possible.
-            if writable:
-                cache_writer.writerow((int(frame_count),
-                                       match_type,
-                                       match_number,
-                                       total_matches,
-                                       time))
+            new_readings[frame_index] = name, time
 
         # Add another frame if this one failed.
         # But if we have reached max frames, do nothing.
-        if (not name or not time) and len(frames) < MOMENT_MAXIMUM_FRAMES:
-            # Failed frame read.
-            frames.append(video.get_frame()) # Read one more frame.
+        if (not name or (not time and not name_only)) and \
+           len(frames) < MOMENT_MAXIMUM_FRAMES:
+            # Failed frame read. Read one more frame, unless it is known.
+            next_index = first + len(frames)
+            if next_index in known:
+                frames.append(None)
+            else:
+                frames.append(next(iter(video.read_burst(next_index, 1)),
+                                   None))
 
         # Save the results.
-        moment[(name, time)] += 1
-
-        # Increment the frame_count
-        frame_count += 1
+        if name_only:
+            key = name.match_type, name.match_number
+            voted.setdefault(key, name)
+            moment[key] += 1
+        else:
+            moment[(name, time)] += 1
+
+    if cache is not None and new_readings:
+        cache.put_many(video, new_readings)
+    if info is not None:
+        info["frame"] = next((frame for frame in reversed(frames)
+                              if frame is not None), None)
+        info["short"] = short
 
     # Now take the results and figure out the reading. Lets do some scrying.
     # We are looking for identical items. Are there more than
@@ -207,31 +237,93 @@ def read_moment(video, data_log = None):
     if float(n)/sum(moment.values()) > MOMENT_IDENTICAL_PERCENTAGE:
         # Yes, Success!
         # Return the common than!
+        if name_only:
+            return voted[common], None
         return common
     # Otherwise, this fails.
     return process_frames.Name_Result('', None, None), None
 
+def moment_known(video, cache, center):
+    """Get what cache (None for nothing) has of the moment around frame
+       center, as {frame: (name, time)}."""
+    if cache is None:
+        return {}
+    first = moment_first(center)
+    return cache.get_range(video, first, first + MOMENT_MAXIMUM_FRAMES)
+
+def moment_cached(center, known):
+    """Whether known (from moment_known) has the whole moment around frame
+       center, so it does not have to be decoded."""
+    first = moment_first(center)
+    return all(index in known for index in
+               range(first, first + MOMENT_MINIMUM_FRAMES))
+
 VERBOSE = 2
 SHOW_VISUAL = True
-
-def scan_video(video, data_log = None):
-    """Complete an inital scan of the video, trying to find all matches."""
+SCAN_ROI = True # Only decode the scoreboard during the scan.
+
+def scan_roi(video):
+    """Only decode the scoreboard of video from now on, if SCAN_ROI."""
+    if SCAN_ROI:
+        video.set_roi(process_frames.scoreboard_roi(video.get_frame_width(),
+                                                    video.get_frame_height()))
+
+def scan_video(video, cache = None, executor = None):
+    """Complete an inital scan of the video, trying to find all matches.
+       cache and executor are passed on to read_moment. A stopped scan picks
+       up from cache, the moments read before are not decoded again."""
+    # One stream for the whole scan, for the frames of each moment.
+    stream = process_frames.Frame_Stream()
     # Set up the video stream.
-    video.set_timestamp(0)
+    scan_roi(video)
+
+    # Run Moment every MATCH_LENGTH / 7 seconds. We want at least two frames
+    # per match. This means we need three chances.
+    match_data = scan_range(video, video.sample_indices(MATCH_LENGTH / 7.),
+                            cache, executor, stream)
 
-    # Run Moment every 60 seconds.
-    timestamp = video.get_timestamp()
-    video_length = video.get_frame_count() * video.get_fps()
+    # Print some data about what was returned.
+    print("Found %d matches." % len(match_data))
+    logging.debug("Delta gating stats: %r" % stream.stats)
+
+    return homogenize_totals(match_data)
+
+def scan_range(video, indices, cache = None, executor = None, stream = None):
+    """Read the moments at the frames in indices, in one forward pass.
+       Returns {timestamp: (name, time)} with the timestamp in ms."""
     blank_count = 0
 
+    # What the cache has of each moment, looked up once for the skip.
+    cached = {}
+    def skip(index):
+        cached[index] = moment_known(video, cache, index)
+        return moment_cached(index, cached[index])
+
     # Memory Structure
     match_data = {}
     try:
-        while timestamp < video_length:
-            if SHOW_VISUAL:
-                video_loader.show_image(video.grab_frame())
-            name, time = read_moment(video, data_log)
+        # Video.iter_sampled reads the burst of each moment, grabbing ahead
+        # or seeking by keyframe to the next one. Moments that are all in the
+        # cache are not decoded.
+        samples = video.iter_sampled(indices = indices, skip = skip,
+                                     burst = MOMENT_MINIMUM_FRAMES)
+        if executor is not None:
+            samples = _submit_ahead(video, samples, executor, cached)
+        else:
+            samples = ((index, timestamp, frames, None)
+                       for index, timestamp, frames in samples)
+        for index, timestamp, frames, submitted in samples:
+            info = {}
+            name, time = read_moment(video, cache, index, executor, stream,
+                                     info, frames = frames,
+                                     known = cached.pop(index),
+                                     submitted = submitted)
+            if SHOW_VISUAL and info["frame"] is not None:
+                # Nothing was decoded when the cache had the whole moment.
+                video_loader.show_image(info["frame"])
             match_data[timestamp] = name, time
+            if not VERBOSE:
+                continue
             if name is not '' or time is not '':
                 # If anything.
                 if blank_count:
@@ -253,22 +345,43 @@ def scan_video(video, data_log = None):
 
                     sys.stdout.write('.' * blank_count + "\r")
                     sys.stdout.flush()
-
-            timestamp += MATCH_LENGTH / 7 * 1000 # We want at least two frames per
-                                                 # match. This means we need three
-                                                 # chances.
-
-            video.set_timestamp(timestamp)
     finally:
         if blank_count:
             print("")
+        if cache is not None:
+            # Keep what was read even if the scan was stopped.
+            cache.commit()
 ##            blank_count = 0 # This is not needed. Never checked again.
 
-    # Print some data about what was returned.
-    print("Found %d matches." % len(match_data))
-
-    # Now, go through the names and homogenized the total number of matches.
+    return match_data
 
+def _submit_ahead(video, samples, executor, cached):
+    """Go through samples (from Video.iter_sampled), handing the bursts of
+       the next ones to executor until it has in_flight frames, so the
+       workers are not left waiting while a moment is decoded and voted on.
+       cached is {index: what the cache has of that moment}.
+       Yields (index, timestamp, frames, submitted) for read_moment."""
+    ahead = deque()
+    in_flight = 0
+    for index, timestamp, frames in samples:
+        if frames is None:
+            # All in the cache, nothing to read.
+            submitted = {}
+        else:
+            submitted = submit_moment(video, executor, index, frames,
+                                      cached[index])
+        ahead.append((index, timestamp, frames, submitted))
+        in_flight += len(submitted)
+        while ahead and in_flight >= executor.in_flight:
+            sample = ahead.popleft()
+            in_flight -= len(sample[3])
+            yield sample
+    while ahead:
+        yield ahead.popleft()
+
+def homogenize_totals(match_data):
+    """Go through the names and homogenized the total number of matches to
+       the most common one. Returns match_data."""
     # Get the frequency of total_matches.
     total_matches=Counter(name.total_matches for name, t in match_data.values())# if name is not None)
     # Remove "None"
@@ -292,6 +405,126 @@ def scan_video(video, data_log = None):
 
     return match_data
 
+# Parallel scan.
+# The samples of one video are split into runs of samples next to each
+# other. Each run is scanned by a worker process with its own Video and its
+# own OCR readers, so a long video scans about as many times faster as there
+# are cores.
+SCAN_CHUNKS_PER_WORKER = 4 # More runs than workers so they finish together.
+
+def _scan_init():
+    """Set up a worker process of a Scan_Pool."""
+    global VERBOSE, SHOW_VISUAL
+    VERBOSE = 0 # The workers would print over each other.
+    SHOW_VISUAL = False
+    process_frames.DEBUG = False
+    process_frames.init()
+
+def _scan_chunk(args):
+    """Scan run part of parts of the samples of a video in a worker process.
+       The video is only opened here, when the run is started."""
+    path, backend, part, parts, cache_path = args
+    video = video_loader.open_video(path, backend)
+    cache = None
+    try:
+        scan_roi(video)
+        # The samples are the same as a scan_video would read.
+        indices = video.sample_indices(MATCH_LENGTH / 7.)
+        size = max(int(math.ceil(len(indices) / float(parts))), 1)
+        if cache_path is not None:
+            cache = scan_cache.Scan_Cache(cache_path)
+        return scan_range(video, indices[part * size:(part + 1) * size], cache)
+    finally:
+        if cache is not None:
+            cache.close()
+        video.close()
+
+class Scan_Job(object):
+    """The parts of one video handed out to a Scan_Pool.
+       get() waits for them and gives the results like scan_video."""
+    def __init__(self, name, parts):
+        self.name = name
+        self.parts = parts # AsyncResults, in order.
+
+    def ready(self):
+        """If every part is done."""
+        return all(part.ready() for part in self.parts)
+
+    def get(self):
+        """Wait for every part and merge them, in order so the merge is
+           always the same."""
+        match_data = {}
+        for number, part in enumerate(self.parts):
+            match_data.update(part.get())
+            logging.debug("%s part %d of %d done." %
+                          (self.name, number + 1, len(self.parts)))
+        print("Found %d matches." % len(match_data))
+        return homogenize_totals(match_data)
+
+class Scan_Pool(object):
+    """Scan_Pool(workers = None)
+       Worker processes (one per core by default) that scan runs of samples
+       of any number of videos. The parts of every video submitted are
+       queued up together, so the workers go from one video straight on to
+       the next.
+    """
+    def __init__(self, workers = None):
+        self.workers = workers or multiprocessing.cpu_count()
+        logging.info("Starting %d scan processes." % self.workers)
+        self.pool = multiprocessing.Pool(self.workers, _scan_init)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def submit(self, path, backend = "cv2", cache = None, chunks = None):
+        """Hand out the scan of the video at path split into chunks runs
+           (SCAN_CHUNKS_PER_WORKER per worker by default). Nothing is opened
+           here, each worker opens the file with backend when it gets to its
+           run. cache is a scan_cache.Scan_Cache, the workers open the same
+           file.
+           If video_loader.KEYFRAME_INDEX, the keyframe index is built here
+           first (if it was not saved before) so the workers all load it
+           instead of each building it on their first seek.
+           Returns a Scan_Job."""
+        chunks = chunks or self.workers * SCAN_CHUNKS_PER_WORKER
+        if video_loader.KEYFRAME_INDEX:
+            video_loader.Keyframe_Index.for_video(path)
+        cache_path = None if cache is None else cache.path
+        if cache is not None:
+            cache.commit() # Let the workers write.
+        name = os.path.basename(path)
+        logging.info("Scanning %s in %d parts." % (name, chunks))
+        return Scan_Job(name, [self.pool.apply_async(
+                                   _scan_chunk,
+                                   ((path, backend, part, chunks, cache_path),))
+                               for part in range(chunks)])
+
+    def close(self):
+        """Finish the scans handed out and stop the workers."""
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """Stop the workers now."""
+        self.pool.terminate()
+        self.pool.join()
+
+def scan_parallel(video, workers = None, chunks = None, backend = "cv2",
+                  cache = None):
+    """Complete an inital scan of video like scan_video, with the samples
+       split into runs read on workers processes. See Scan_Pool.submit.
+    """
+    # The same view as the workers, for anything read here later.
+    scan_roi(video)
+    with Scan_Pool(workers) as pool:
+        return pool.submit(video.path, backend, cache, chunks).get()
+
 def time_video(results):
     """Take the dictionary built from video scanner and use it to
        find holes. Returns a list of missing matches, a calculated
@@ -329,7 +562,347 @@ def time_video(results):
 
     return final_times
 
-import time
+def find_edge(present, inside, outside, guess = None):
+    """Find the last frame, going from inside towards outside, where
+       present(frame) is still True. present(inside) must be True and
+       present(outside) False; neither is checked again.
+       If guess is a frame that should be near the edge, the search gallops
+       out from guess (steps of 1, 2, 4, ...) until it passes the edge.
+       Then the edge is found by bisection.
+    """
+    direction = 1 if outside > inside else -1
+
+    def between(frame):
+        return (frame - inside) * direction > 0 and \
+               (outside - frame) * direction > 0
+
+    if guess is not None and between(guess):
+        step = 1
+        if present(guess):
+            # Gallop towards outside.
+            inside = guess
+            while between(inside + direction * step):
+                if not present(inside + direction * step):
+                    outside = inside + direction * step
+                    break
+                inside += direction * step
+                step *= 2
+        else:
+            # Gallop back towards inside.
+            outside = guess
+            while between(outside - direction * step):
+                if present(outside - direction * step):
+                    inside = outside - direction * step
+                    break
+                outside -= direction * step
+                step *= 2
+
+    # Bisect what is left.
+    while abs(outside - inside) > 1:
+        middle = (inside + outside) // 2
+        if present(middle):
+            inside = middle
+        else:
+            outside = middle
+    return inside
+
+def refine_matches(video, results, cache = None, executor = None,
+                   stream = None):
+    """Take the dictionary built from scan_video and find the first and last
+       frame of each match, reading more frames of video around the samples.
+       A match is where the scoreboard shows its name. Each edge is searched
+       for between the last sample without the match and the first one with
+       it, starting from where the timer says the match started. This needs a
+       logarithmic number of read_moment calls.
+       Returns a list of (match_name, start_time, stop_time) in seconds, like
+       time_video. cache, executor and stream are passed to read_moment.
+    """
+    if stream is None:
+        stream = process_frames.Frame_Stream()
+    fps = video.get_fps()
+    last_frame = int(video.get_frame_count()) - 1
+
+    # The samples as (frame, name, time) in order.
+    samples = sorted((int(round(timestamp * fps / 1000.)), name, time)
+                     for timestamp, (name, time) in results.items())
+
+    final_times = []
+    probes = [0]
+    for match_name in unique(name for index, name, time in samples):
+        if not match_name:
+            continue
+
+        readings = {} # frame -> name, so no frame is read twice.
+        def present(frame):
+            if frame not in readings:
+                probes[0] += 1
+                readings[frame] = read_moment(video, cache, frame, executor,
+                                              stream, name_only = True)[0]
+            return same_match(readings[frame], match_name)
+
+        positions = [number for number, sample in enumerate(samples)
+                     if sample[1] == match_name]
+        first, last = positions[0], positions[-1]
+        # A sample next to the match may have been read blank only because
+        # its moment did not agree, so go out to samples that really are
+        # without it.
+        while first > 0 and present(samples[first - 1][0]):
+            first -= 1
+        while last + 1 < len(samples) and present(samples[last + 1][0]):
+            last += 1
+
+        # Where the timer says the match started.
+        timed = [index - time * fps for index, name, time
+                 in samples[first:last + 1] if name == match_name and time]
+        if timed:
+            timer_start = int(sum(timed) / len(timed))
+            start_guess = timer_start
+            stop_guess = timer_start + int(MATCH_LENGTH * fps)
+        else:
+            start_guess = stop_guess = None
+
+        # The edges are between these samples and the next ones out.
+        before = samples[first - 1][0] if first > 0 else -1
+        after = samples[last + 1][0] if last + 1 < len(samples) \
+                else last_frame + 1
+
+        start_frame = find_edge(present, samples[first][0], before,
+                                start_guess)
+        stop_frame = find_edge(present, samples[last][0], after,
+                               stop_guess)
+
+        start_time = start_frame / fps
+        stop_time = (stop_frame + 1) / fps
+        final_times.append((match_name, start_time, stop_time))
+
+        print("% 24s starts at % 8d and finishes at % 8d." %
+              (match_name, start_time, stop_time))
+
+    logging.debug("Refined %d matches with %d reads." %
+                  (len(final_times), probes[0]))
+    return final_times
+
+# Streaming scan.
+# A recording that is still being written is followed as it grows. The
+# samples are the same as scan_video reads, but each is looked at as soon as
+# it is in the file and a Match_Event comes out as soon as a match's start
+# or end is known.
+STREAM_MARGIN = 5. # Seconds at the end of a growing video left for later.
+STREAM_POLL = 2. # Seconds to wait for the video to grow.
+STREAM_SETTLE = 60. # Seconds without growing before a video is done.
+STREAM_END_SAMPLES = 2 # Samples in a row without the match to end it.
+
+Match_Event = namedtuple("Match_Event", ["kind", "name", "time"])
+Match_Event.__doc__ = """Match_Event(kind, name, time)
+       kind is "start" or "end", name the Name_Result of the match and time
+       the seconds into the video."""
+
+def same_match(name, other):
+    """If name and other are the same match, even if total_matches was read
+       differently."""
+    return bool(name) and bool(other) and \
+           name.match_type == other.match_type and \
+           name.match_number == other.match_number
+
+class _Match_Tracker(object):
+    """What the stream knows about the match being shown.
+       A match only ends after STREAM_END_SAMPLES samples in a row without
+       it, so one blank or misread sample does not split it in two."""
+    def __init__(self, fps):
+        self.fps = fps
+        self.current = None # Name of the match being shown.
+        self.last_in = None # Last sample with it.
+        self.timer_start = None # Frame its timer says it started.
+        self.previous = -1 # Last sample.
+        self.pending = [] # (index, name, time) since last_in, without it.
+
+    def sample(self, index, name, time, locate):
+        """Take the reading of the sample at index. locate(name, inside,
+           outside, guess) finds the edge frame of name between two samples.
+           Returns the Match_Events it shows."""
+        events = []
+        if self.current is not None:
+            if same_match(name, self.current):
+                # Anything pending was misread, the match goes on.
+                self.last_in = index
+                self.pending = []
+            else:
+                self.pending.append((index, name, time))
+                if len(self.pending) >= STREAM_END_SAMPLES:
+                    events.extend(self._replay(locate))
+            self.previous = index
+            return events
+        if name:
+            guess = int(index - time * self.fps) if time else None
+            start = locate(name, index, self.previous, guess)
+            events.append(Match_Event("start", name, start / self.fps))
+            self.current, self.last_in, self.timer_start = name, index, guess
+        self.previous = index
+        return events
+
+    def _replay(self, locate):
+        """End the match being shown at the first pending sample and take
+           the pending samples again. Returns the Match_Events."""
+        pending, self.pending = self.pending, []
+        events = [self.end(pending[0][0], locate)]
+        for index, name, time in pending:
+            events.extend(self.sample(index, name, time, locate))
+        return events
+
+    def finish(self, outside, locate):
+        """The video ended, the first frame without it is at or before
+           outside. Returns the Match_Events of what is left."""
+        events = []
+        if self.pending:
+            events.extend(self._replay(locate))
+        if self.current is not None:
+            events.append(self.end(outside, locate))
+        return events
+
+    def end(self, outside, locate):
+        """End the match being shown, the first frame without it is at or
+           before outside. Returns its Match_Event."""
+        guess = None
+        if self.timer_start is not None:
+            guess = self.timer_start + int(MATCH_LENGTH * self.fps)
+        stop = locate(self.current, self.last_in, outside, guess)
+        event = Match_Event("end", self.current, (stop + 1) / self.fps)
+        self.previous = self.last_in
+        self.current = self.last_in = self.timer_start = None
+        return event
+
+def stream_matches(source, backend = "cv2", cache = None, executor = None,
+                   done = None, poll = None):
+    """Follow the video at source while it is being written and yield a
+       Match_Event for each match start and end as soon as it is known.
+
+       The file is opened again whenever the samples in it run out, and
+       only the new ones are read. The last STREAM_MARGIN seconds are left
+       until more is written, and so is any sample where the video gave
+       fewer frames than it said it had. The edges are found like refine_matches does.
+       done() tells when the video is complete. By default, that is when it
+       has not grown for STREAM_SETTLE seconds. Then a match still being
+       shown ends at the end of the video and the generator stops.
+       When there is nothing new, it waits STREAM_POLL seconds, or, if
+       poll is False, yields None so the caller can come back later.
+
+       If source is not a file (a capture or anything ffmpeg can read), it
+       is read straight through once and the edges are only known to a
+       sample. cache and executor are as for scan_video.
+    """
+    if not os.path.isfile(source):
+        for event in _stream_live(source, backend, executor):
+            yield event
+        return
+
+    if poll is None:
+        poll = STREAM_POLL
+    stream = process_frames.Frame_Stream()
+    tracker = None
+    scanned = -1 # Last sample read.
+    grown = [0, now()] # Last frame count and when it changed.
+    if done is None:
+        def done():
+            return now() - grown[1] >= STREAM_SETTLE
+
+    while True:
+        complete = done() # Before looking, so nothing written after is lost.
+        try:
+            # A keyframe index of a growing file would be out of date.
+            video = video_loader.open_video(source, backend,
+                                            keyframe_index = False)
+        except ValueError:
+            video = None
+            logging.debug("%s can't be read yet." % source)
+
+        if video is not None:
+            try:
+                if SCAN_ROI:
+                    video.set_roi(process_frames.scoreboard_roi(
+                        video.get_frame_width(), video.get_frame_height()))
+                fps = video.get_fps()
+                if tracker is None:
+                    tracker = _Match_Tracker(fps)
+                frame_count = video.get_frame_count()
+                if frame_count != grown[0]:
+                    grown[:] = frame_count, now()
+
+                def locate(name, inside, outside, guess):
+                    readings = {}
+                    def present(frame):
+                        if frame not in readings:
+                            readings[frame] = read_moment(
+                                video, cache, frame, executor, stream,
+                                name_only = True)[0]
+                        return same_match(readings[frame], name)
+                    return find_edge(present, inside, outside, guess)
+
+                stop = frame_count
+                if not complete:
+                    stop -= int(STREAM_MARGIN * fps)
+                indices = [index for index in video.sample_indices(
+                               MATCH_LENGTH / 7., stop = max(stop, 0))
+                           if index > scanned]
+                for index in indices:
+                    info = {}
+                    name, timer = read_moment(video, cache, index, executor,
+                                              stream, info)
+                    if info["short"] and not complete:
+                        # The frame count of a growing file is only a guess,
+                        # this moment isn't all written yet. Read it again
+                        # once the file has grown.
+                        break
+                    scanned = index
+                    for event in tracker.sample(index, name, timer, locate):
+                        yield event
+                if cache is not None:
+                    cache.commit()
+
+                if complete:
+                    for event in tracker.finish(frame_count, locate):
+                        yield event
+                    return
+            finally:
+                video.close()
+        elif complete:
+            return
+
+        if poll is False:
+            yield None
+        else:
+            sleep(poll)
+
+def _stream_live(source, backend = "cv2", executor = None):
+    """stream_matches for a source that can only be read forward once."""
+    video = video_loader.open_video(source, backend, keyframe_index = False)
+    try:
+        if SCAN_ROI:
+            video.set_roi(process_frames.scoreboard_roi(
+                video.get_frame_width(), video.get_frame_height()))
+        fps = video.get_fps()
+        step = MATCH_LENGTH / 7. * fps
+        stream = process_frames.Frame_Stream()
+        tracker = _Match_Tracker(fps)
+        # Can't go back, so an edge is the sample after it.
+        locate = lambda name, inside, outside, guess: max(outside, 0)
+
+        sample = 0
+        while True:
+            index = int(round(sample * step))
+            # Read forward to the first frame of the moment.
+            first = max(index - MOMENT_MINIMUM_FRAMES // 2, 0)
+            gap = first - int(video.get_frame_index())
+            if gap > 0 and video.skip_frames(gap) < gap:
+                break # The end of the stream.
+            name, timer = read_moment(video, None, index, executor, stream)
+            for event in tracker.sample(index, name, timer, locate):
+                yield event
+            sample += 1
+
+        for event in tracker.finish(int(video.get_frame_index()), locate):
+            yield event
+    finally:
+        video.close()
 
 # ffmpeg -i source-file.foo -ss 1200 -t 600 third-10-min.m4v
 # ffmpeg_command = 'ffmpeg -i %r -ss %r -t %r %r'
@@ -344,10 +917,50 @@ def ffmpeg_command(source, start_time, stop_time, output):
 
             output]
 
-def write_files(video, timings, output_folder = None):
-    """Write the videos that are found in the output."""
+# One ffmpeg for all the clips. The -ss and -to after -i apply to each
+# output, so the source is read once from start to end and the gaps between
+# matches are thrown away instead of every clip opening and seeking the
+# source itself.
+# A copied clip can only start on a keyframe, and an output -ss drops
+# everything up to the next one, so a clip would start up to a whole group
+# of pictures late. With the keyframe index, each start is moved back to the
+# keyframe before it instead (and a little more, so rounding can't miss it).
+SINGLE_PASS_MARGIN = .1 # seconds
+
+def ffmpeg_single_pass_command(source, clips, keyframes = None):
+    """clips is a list of (start_time, stop_time, output) in seconds.
+       keyframes is the video_loader.Keyframe_Index of source, if any."""
+    command = ['ffmpeg',
+               '-loglevel', 'warning', # Less output
+               '-i', source]
+    for start_time, stop_time, output in sorted(clips):
+        if keyframes is not None:
+            # Output times start at the first keyframe, not at zero.
+            origin = keyframes.timestamps[0]
+            keyframe_time = keyframes.keyframe_before_timestamp(
+                start_time * 1000. + origin)[1]
+            start_time = max((keyframe_time - origin) / 1000. -
+                             SINGLE_PASS_MARGIN, 0)
+        command.extend(['-ss', str(start_time),
+                        '-to', str(stop_time),
+                        '-codec', 'copy', # Don't re-encode.
+                        '-avoid_negative_ts', 'make_zero',
+                        output])
+    return command
+
+def write_files(video, timings, output_folder = None, jobs = None,
+                single_pass = False, record = None):
+    """Write the videos that are found in the output.
+       video is the video_loader.Video the timings are from, or its path.
+       Up to jobs (ffmpeg_pool.FFMPEG_JOBS by default) clips are cut at once.
+       With single_pass, one ffmpeg reads the video once and writes all the
+       clips instead.
+       If record (a manifest.Manifest) is given, clips are marked in it when
+       written and a clip that is there but not marked is cut again.
+       Returns the ffmpeg_pool.Job_Results."""
+    path = getattr(video, "path", video)
     # First, get rid of any recongnizable extension.
-    video_name = video.name
+    video_name = os.path.basename(path)
     if   video_name.endswith(".mp4"): video_name = video_name.rstrip(".mp4")
     elif video_name.endswith(".mov"): video_name = video_name.rstrip(".mov")
 
@@ -357,28 +970,53 @@ def write_files(video, timings, output_folder = None):
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
 
+    commands = []
+    clips = []
+    outputs = {} # label -> output_file
     for match_name, start_time, stop_time in timings:
         # Put together the file location.
         output_file = os.path.join(output_folder, str(match_name) + ".mp4")
 
         if os.path.exists(output_file):
-            continue
+            if record is None or record.is_clip_done(path, output_file):
+                continue
+            # Left from a cut that was stopped.
+            logging.info("Cutting %s again." % output_file)
+            os.remove(output_file)
         print("Make file %s" % output_file)
+        outputs[str(match_name)] = output_file
+        if single_pass:
+            clips.append((start_time, stop_time, output_file))
+            continue
 
-        # Create and processing command and launch!
-        command = ffmpeg_command(video.path, start_time, stop_time, output_file)
+        # Create and processing command.
+        command = ffmpeg_command(path, start_time, stop_time, output_file)
+        print("Command: %s" % subprocess.list2cmdline(command))
+        commands.append((str(match_name), command))
+
+    if single_pass:
+        if not clips:
+            return []
+        command = ffmpeg_single_pass_command(
+            path, clips, video_loader.Keyframe_Index.for_video(
+                path, video_loader.KEYFRAME_INDEX))
         print("Command: %s" % subprocess.list2cmdline(command))
-        output=subprocess.Popen(command,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-
-        # Monitor the process as it runs.
-        while output.poll() is None:
-            output.stdout.flush()
-            x = output.stdout.readline()
-            if x: logging.debug("ffmepg %r" % x)
-            time.sleep(.1)
-        print("Finished with status %s" % output.poll())
+        result = ffmpeg_pool.run_command(os.path.basename(path), command)
+        if record is not None and result.status == 0:
+            for output_file in outputs.values():
+                record.clip_done(path, output_file)
+        return ffmpeg_pool.report([result])
+
+    def recorded(results):
+        """Mark each clip as soon as it is written."""
+        for result in results:
+            if record is not None and result.status == 0:
+                record.clip_done(path, outputs[result.label])
+            yield result
+
+    # Launch! The cuts are stream copies, so they overlap well.
+    with ffmpeg_pool.FFmpeg_Pool(jobs) as pool:
+        return ffmpeg_pool.report(recorded(pool.run(commands)))
 
 def test(args = None):
     # Get argument.
@@ -399,9 +1037,9 @@ def test(args = None):
         video = video_loader.Video(f)
         try:
             results = scan_video(video)
+            timings = refine_matches(video, results)
             # Close the windows.
             process_frames.deinit()
-            timings = time_video(results)
             write_files(video, timings)
         except KeyboardInterrupt:
             print("KeyboardInterrupt")
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""Render the title card of each clip once and stitch it on without
+re-encoding the clip.
+
+Every finished video is the same intro with a different title drawn on it,
+followed by the clip. Instead of re-encoding both, the intro with the title
+is rendered on its own, with the same codec, size, frame rate and audio as
+the clip. It is kept in a cache folder keyed by the title, the intro file
+and those parameters. Then intro and clip are joined with stream copy.
+
+The intro can't have the same codec setup (SPS/PPS for h264) as the clip
+byte for byte, and an MP4 only has room for one. So both are joined as
+MPEG-TS, which carries the setup in the stream at every keyframe: the clip
+is remuxed to TS, the intro is rendered as TS, and the concat demuxer
+writes them to the MP4. When the parameters can't be matched, the whole
+video is re-encoded like before, and clips like it skip straight to that.
+
+Intro_Cache(folder, intro)  The rendered intros in folder.
+stream_params(path)         The parameters of the first video and audio stream.
+finish_clip                 Put the intro on one clip.
+"""
+import os
+import json
+import hashlib
+import logging
+import subprocess
+
+import ffmpeg_pool
+import video_loader
+
+__all__ = ["Intro_Cache", "stream_params", "finish_clip", "INTRO_CACHE_DIR"]
+
+INTRO_CACHE_DIR = ".intro_cache" # Folder in the target folder.
+INTRO_FONT = "/Library/Fonts/Trebuchet MS.ttf"
+
+# Encoders that make streams the concat demuxer can join to a decoded codec.
+ENCODERS = {"h264": "libx264", "hevc": "libx265", "mpeg4": "mpeg4",
+            "aac": "aac", "mp3": "libmp3lame"}
+X264_PROFILES = {"Baseline": "baseline", "Main": "main", "High": "high"}
+
+# The render is fast but keeps the features (CABAC, B-frames, 8x8dct) that
+# make the profile x264 writes the same as the clip's. ultrafast would
+# always come out as Constrained Baseline.
+RENDER_PRESETS = {"libx264": "veryfast", "libx265": "veryfast"}
+# Bitstream filters that put the codec setup in the stream for MPEG-TS.
+ANNEXB_FILTERS = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+
+# What has to be the same in intro and clip to join them without encoding.
+VIDEO_KEYS = ("codec_name", "profile", "level", "width", "height",
+              "pix_fmt", "r_frame_rate")
+AUDIO_KEYS = ("codec_name", "profile", "sample_rate", "channels")
+
+def stream_params(path):
+    """Get {"video": {...}, "audio": {...}} of the first video and audio
+       stream of path with ffprobe. A missing stream is an empty dict."""
+    command = [video_loader.FFPROBE, '-v', 'error', '-show_streams',
+               '-of', 'json', path]
+    logging.debug(subprocess.list2cmdline(command))
+    data = json.loads(subprocess.check_output(command).decode())
+    params = {"video": {}, "audio": {}}
+    for stream in data.get("streams", []):
+        kind = stream.get("codec_type")
+        if kind in params and not params[kind]:
+            params[kind] = stream
+    return params
+
+def _matching(params):
+    """The part of params that has to match."""
+    return ([params["video"].get(key) for key in VIDEO_KEYS] +
+            [params["audio"].get(key) for key in AUDIO_KEYS])
+
+_hashes = {}
+def file_hash(path):
+    """sha1 of the file at path, remembered while the file is unchanged."""
+    stat = os.stat(path)
+    key = path, stat.st_size, stat.st_mtime
+    if key not in _hashes:
+        digest = hashlib.sha1()
+        with open(path, "rb") as data:
+            for block in iter(lambda: data.read(1 << 20), b""):
+                digest.update(block)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+class Intro_Cache(object):
+    """Intro_Cache(folder, intro, fontfile = INTRO_FONT)
+       Title cards made from the intro video, rendered into folder.
+    """
+    def __init__(self, folder, intro, fontfile = INTRO_FONT):
+        self.folder = folder
+        self.intro = intro
+        self.fontfile = fontfile
+        # _matching of clips whose intro did not match, as json. They are
+        # re-encoded without rendering an intro again.
+        self.unjoinable = set()
+
+    def joinable(self, params):
+        """If a clip with params might be joined, as far as is known."""
+        return json.dumps(_matching(params)) not in self.unjoinable
+
+    def not_joinable(self, params):
+        """Remember that the intro for clips with params does not match."""
+        self.unjoinable.add(json.dumps(_matching(params)))
+
+    def key(self, text, params):
+        """The key of the intro for text made to match params."""
+        video = params["video"]
+        key = [text, file_hash(self.intro), video.get("width"),
+               video.get("height"), video.get("r_frame_rate")]
+        key.extend(_matching(params))
+        return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def path(self, text, params):
+        """Where the intro for text made to match params is kept."""
+        return os.path.join(self.folder, self.key(text, params) + ".ts")
+
+    def render_command(self, text, params, output):
+        """ffmpeg command that renders the intro for text matching params.
+           Returns None if there is no encoder for the codecs of params."""
+        video, audio = params["video"], params["audio"]
+        try:
+            video_encoder = ENCODERS[video["codec_name"]]
+            audio_encoder = ENCODERS[audio["codec_name"]]
+        except KeyError:
+            return None
+
+        command = [video_loader.FFMPEG,
+                   '-y', '-nostdin', '-nostats', '-i', self.intro,
+                   '-vf', (
+                       'drawtext=enable=between(t\\,3\\,9):'
+                       'fontcolor=white:fontfile=%r:'
+                       'fontsize=36:text=%r:'
+                       'x=text_w/16:y=(h-text_h)/2,'
+                       'scale=%d:%d,fps=%s,format=%s'
+                       % (self.fontfile, text, video["width"],
+                          video["height"], video["r_frame_rate"],
+                          video["pix_fmt"])),
+                   '-c:v', video_encoder]
+        if video_encoder in RENDER_PRESETS:
+            command.extend(['-preset', RENDER_PRESETS[video_encoder]])
+        if video_encoder == "libx264":
+            if video.get("profile") in X264_PROFILES:
+                command.extend(['-profile:v', X264_PROFILES[video["profile"]]])
+            if video.get("level", 0) > 0:
+                command.extend(['-level:v', str(video["level"])])
+        command.extend(['-c:a', audio_encoder,
+                        '-ar', str(audio["sample_rate"]),
+                        '-ac', str(audio["channels"]),
+                        output])
+        return command
+
+    def get(self, text, params, progress = None):
+        """Get the path of the intro for text matching params, rendering it
+           if it is not in the cache yet.
+           Returns (path, Job_Result of the render or None); path is None if
+           it can't be made."""
+        path = self.path(text, params)
+        if os.path.exists(path):
+            logging.debug("Intro for %r is cached at %r." % (text, path))
+            return path, None
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        # Render next to it and move into place, so a stopped render is
+        # never taken for a finished one.
+        temp = path + ".part.ts"
+        command = self.render_command(text, params, temp)
+        if command is None:
+            return None, None
+        result = ffmpeg_pool.run_command("intro %s" % text, command, progress)
+        if result.status != 0:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return None, result
+        os.replace(temp, path)
+        return path, result
+
+def _concat_file(paths, list_file):
+    """Write the concat demuxer list of paths to list_file."""
+    with open(list_file, "w") as out_file:
+        for path in paths:
+            out_file.write("file '%s'\n" %
+                           os.path.abspath(path).replace("'", "'\\''"))
+
+def remux_command(clip, params, output):
+    """ffmpeg command that copies clip (with params) into the MPEG-TS
+       output, with the codec setup in the stream."""
+    command = [video_loader.FFMPEG,
+               '-y', '-nostdin', '-nostats', '-i', clip, '-c', 'copy']
+    video_filter = ANNEXB_FILTERS.get(params["video"].get("codec_name"))
+    if video_filter is not None:
+        command.extend(['-bsf:v', video_filter])
+    command.extend(['-f', 'mpegts', output])
+    return command
+
+def concat_command(list_file, params, output):
+    """ffmpeg command that joins the MPEG-TS files in list_file (with
+       params) into output without encoding."""
+    command = [video_loader.FFMPEG,
+               '-y', '-nostdin', '-nostats',
+               '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy']
+    if params["audio"].get("codec_name") == "aac":
+        # MPEG-TS has ADTS headers on every frame, MP4 does not.
+        command.extend(['-bsf:a', 'aac_adtstoasc'])
+    command.append(output)
+    return command
+
+def finish_clip(cache, text, clip, output, fallback, progress = None):
+    """Put the intro for text in front of clip and write it to output.
+       The intro comes from cache (an Intro_Cache) and is joined by stream
+       copy through MPEG-TS. If that can't be done, the fallback ffmpeg
+       command (a full re-encode) is run instead.
+       Returns the ffmpeg_pool.Job_Result of the last command with the time
+       of all of them."""
+    seconds = 0.
+    try:
+        params = stream_params(clip)
+    except (subprocess.CalledProcessError, OSError, ValueError) as error:
+        logging.error("Could not probe %r: %s" % (clip, error))
+        params = None
+
+    if params is not None and cache.joinable(params):
+        intro, render = cache.get(text, params, progress)
+        if render is not None:
+            seconds += render.seconds
+        if intro is not None:
+            try:
+                if _matching(stream_params(intro)) != _matching(params):
+                    intro = None
+            except (subprocess.CalledProcessError, OSError,
+                    ValueError) as error:
+                logging.error("Could not probe %r: %s" % (intro, error))
+                intro = None
+        if intro is None:
+            logging.info("Can't make an intro for %r that matches the clip."
+                         % text)
+            cache.not_joinable(params)
+        else:
+            result = _join(text, intro, clip, params, output, progress)
+            seconds += result.seconds
+            if result.status == 0:
+                return result._replace(seconds = seconds)
+
+    # Could not join them, encode everything.
+    logging.info("Re-encoding %r with the intro." % text)
+    result = ffmpeg_pool.run_command(text, fallback, progress)
+    return result._replace(seconds = seconds + result.seconds)
+
+def _join(text, intro, clip, params, output, progress = None):
+    """Remux clip to MPEG-TS and join the intro to it into output.
+       Returns the Job_Result of the last command with the time of both."""
+    clip_ts = output + ".clip.ts"
+    list_file = output + ".concat.txt"
+    try:
+        result = ffmpeg_pool.run_command(
+            text, remux_command(clip, params, clip_ts), progress)
+        if result.status != 0:
+            return result
+        seconds = result.seconds
+        _concat_file((intro, clip_ts), list_file)
+        result = ffmpeg_pool.run_command(
+            text, concat_command(list_file, params, output), progress)
+        return result._replace(seconds = seconds + result.seconds)
+    finally:
+        for path in (clip_ts, list_file):
+            if os.path.exists(path):
+                os.remove(path)
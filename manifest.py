@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Keep a record of the work done in a target folder, so a stopped parse or
+finish picks up where it stopped.
+
+The record is one JSON file in the target folder. For each video (by
+scan_cache.video_key, so a moved video is still known) it has the matches
+found and the clips written, and for finish which videos were finished. A
+scan that was stopped is not recorded here, it picks up from the scan cache.
+Every change is written to a temporary file that then replaces the record,
+so the record is never half written.
+
+Manifest(folder)       The record of folder.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+
+import scan_cache
+
+__all__ = ["Manifest", "MANIFEST_FILE"]
+
+MANIFEST_FILE = "manifest.json"
+
+class Manifest(object):
+    """Manifest(folder)
+       The record of the work done in folder. Safe to use from more than one
+       thread.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE)
+        self.lock = threading.RLock()
+        self.keys = {} # path -> ((size, mtime), key)
+        try:
+            with open(self.path) as in_file:
+                self.data = json.load(in_file)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+        self.data.setdefault("videos", {})
+        self.data.setdefault("finished", {})
+
+    def save(self):
+        """Write the record to disk, all at once."""
+        with self.lock:
+            descriptor, temp = tempfile.mkstemp(
+                prefix = MANIFEST_FILE, suffix = ".tmp", dir = self.folder)
+            try:
+                with os.fdopen(descriptor, "w") as out_file:
+                    json.dump(self.data, out_file, indent = True,
+                              sort_keys = True)
+                    out_file.flush()
+                    os.fsync(out_file.fileno())
+                os.replace(temp, self.path)
+            except:
+                os.remove(temp)
+                raise
+
+    def key(self, path):
+        """The key of the video at path. The start of a video that is still
+           being written can change, so the key is worked out again each
+           time the size or modification time of the file do."""
+        with self.lock:
+            stat = os.stat(path)
+            signature = stat.st_size, stat.st_mtime
+            known = self.keys.get(path)
+            if known is None or known[0] != signature:
+                known = self.keys[path] = signature, scan_cache.video_key(path)
+            return known[1]
+
+    def video(self, path):
+        """The record of the video at path."""
+        with self.lock:
+            key = self.key(path)
+            videos = self.data["videos"]
+            if key not in videos:
+                # A video that was recorded while it was being written is
+                # under the key it had then. Its matches are only set once
+                # it is complete, so only take over a record without them.
+                for old in list(videos):
+                    if videos[old].get("path") == path and \
+                       videos[old].get("matches") is None:
+                        videos[key] = videos.pop(old)
+                        break
+            entry = videos.setdefault(key, {})
+            entry["path"] = path
+            entry.setdefault("matches", None)
+            entry.setdefault("clips", {})
+            return entry
+
+    def set_matches(self, path, timings):
+        """Record the (match_name, start_time, stop_time) found in path."""
+        with self.lock:
+            self.video(path)["matches"] = [[str(name), start, stop]
+                                           for name, start, stop in timings]
+            self.save()
+
+    def get_matches(self, path):
+        """The matches found in path before, or None if it was not done."""
+        with self.lock:
+            matches = self.video(path)["matches"]
+        if matches is None:
+            return None
+        return [tuple(match) for match in matches]
+
+    def clip_done(self, path, output):
+        """Record that the clip output of the video at path is written."""
+        with self.lock:
+            self.video(path)["clips"][output] = time.time()
+            self.save()
+
+    def is_clip_done(self, path, output):
+        """If the clip output of path was written completely."""
+        with self.lock:
+            return output in self.video(path)["clips"] and \
+                   os.path.exists(output)
+
+    def finish_done(self, source, output):
+        """Record that source was finished into output."""
+        with self.lock:
+            self.data["finished"][output] = {"source": source,
+                                             "time": time.time()}
+            self.save()
+
+    def is_finished(self, output):
+        """If output was finished completely."""
+        with self.lock:
+            return output in self.data["finished"] and os.path.exists(output)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.folder)
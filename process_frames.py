@@ -3,10 +3,12 @@
 Take a frame and do the reading of it.
 
 read_image(img)     Read the image with the ocr.
+scoreboard_roi(w, h) The part of a w by h frame that read_image looks at.
+
+Frame_Executor()    Read many images at once on a pool of processes.
 
 TODO
 Add logging with all results going to info() and all failures going to debug().
-Add a threading pool so x images can be processed by y threads.
 Make the threading pool smart so to increase efficiency on the fly.
 Figure out how ocr.ClearAdaptiveClassifier() works so I can actually use it
 efficiently.
@@ -18,10 +20,12 @@ import sys
 import difflib
 import logging
 from math import ceil, floor # For pixel corrections.
-from collections import namedtuple
+import hashlib
+from collections import namedtuple, deque, OrderedDict
 
 import tesserocr
 from PIL import Image
+import numpy as np
 from numpy import ndarray
 from extract_lib import extract_image
 # Format: (x, y, width, height) Assumed frame size (512, 288)
@@ -77,6 +81,7 @@ DEFAULT_SIZE = (512, 288)
 
 # And for threading
 import threading
+import multiprocessing
 try:
     import Queue as queue
 except ImportError:
@@ -85,6 +90,18 @@ except ImportError:
 MATCH_LENGTH = 180
 
 __all__ = ["read_image",
+           "scoreboard_rects",
+           "scoreboard_roi",
+           "overlay_present",
+           "overlay_hit_rate",
+           "OVERLAY_FILTER",
+           "Digit_Reader",
+           "Frame_Executor",
+           "ROI_Cache",
+           "Frame_Stream",
+           "DELTA_THRESHOLD",
+           "OCR_CACHE",
+           "DIGIT_READER",
            "DEBUG",
            "VERBOSE",
            "REG_NAME_ENLARGE",
@@ -266,6 +283,11 @@ class Name_Result(object):
 
     __nonzero__ = __bool__
 
+    def __getnewargs__(self):
+        """Arguments for __new__ when unpickling, so results can come back
+           from worker processes."""
+        return self.match_type, self.match_number, self.total_matches
+
     def __str__(self):
         """Print string representation of the object."""
         if not self:
@@ -621,36 +643,28 @@ def init():
 def deinit():
     """Deinitalize the processor."""
     logging.info("Deinitalizing process_frames.py")
+    logging.info("Scoreboard pre-filter skipped OCR on %d of %d frames (%.1f%%)."
+                 % (OVERLAY_STATS["skipped"], OVERLAY_STATS["checked"],
+                    overlay_hit_rate() * 100))
+    logging.info("Digit reader stats: %r" % DIGITS.stats)
+    logging.info("Name cache stats: %r" % NAME_CACHE.stats)
+    logging.info("Time cache stats: %r" % TIME_CACHE.stats)
     # This frees up the memory and closes the cv2 windows.
     NAME_POOL = queue.Queue(NAME_POOL_SIZE)
     TIME_POOL = queue.Queue(TIME_POOL_SIZE)
     cv2.destroyAllWindows()
 
-def read_image(image, name_hook = None, time_hook = None):
-    """Take image files and try to read the words from them.
-       Takes a numpy image.
-       name_hook, and time_hook should be functions that are called with the
-       values for name and hook, preprocessed and postprocessed.
+def scoreboard_rects(frame_width, frame_height):
+    """Get the pixel boxes of the name and the time for a frame of the given
+       size. Each is (left, top, right, bottom).
     """
-    assert not NAME_POOL.empty(), "process_frames.NAME_POOL not initalized."
-    assert not TIME_POOL.empty(), "process_frames.TIME_POOL not initalized."
-
-    # Verify this is a valid image.
-    if not is_numpy_image(image):
-        # Error, bad image.
-        raise TypeError("Image should have been a numpy array, not %r." % image)
-
-    # Extract the 2 portions with information.
-    # Crop numpy image. NOTE: its img[y: y + h, x: x + w]
     nx, ny, nw, nh = MATCH_NAME_RECT
     tx, ty, tw, th = MATCH_TIME_RECT
     # Take into effect the scaling factor of the screen size.
     dx, dy = DEFAULT_SIZE
-    iy, ix, _ = image.shape # Y and X sizes. There is a third argument which
-    # I think is color depth?
 
     # Calculate a scale factor. Assume a cropping on the horizontal if needed.
-    r_x, r_y = ix * 1. / dx, iy * 1. / dy
+    r_x, r_y = frame_width * 1. / dx, frame_height * 1. / dy
     # Actually, r_y is more reliable.
     r_x = r_y
     assert r_x != 0 and r_y != 0
@@ -661,18 +675,23 @@ def read_image(image, name_hook = None, time_hook = None):
     assert all([name_top,    time_top,   name_left, time_left,
                 name_bottom, time_bottom,name_right,time_right])
 
-    # Where it matters, make the box a little larger for rounding error.
-##    name_frame = image[ny : ny + nh, nx : nx + nw]
-##    time_frame = image[ty : ty + th, tx : tx + tw]
-    name_frame = image[name_top : name_bottom, name_left : name_right]
-    time_frame = image[time_top : time_bottom, time_left : time_right]
-##    del image # Its a full image in memory. Clear as fast as possible.
-
-    # For testing.
-    if DEBUG:
-        cv2.imshow("Name", name_frame)
-        cv2.imshow("Time", time_frame)
+    return ((name_left, name_top, name_right, name_bottom),
+            (time_left, time_top, time_right, time_bottom))
 
+def scoreboard_roi(frame_width, frame_height):
+    """Get the smallest box (x, y, width, height) holding both the name and
+       the time for a frame of the given size. Only this part of a frame is
+       needed by read_image.
+    """
+    name_rect, time_rect = scoreboard_rects(frame_width, frame_height)
+    left  = min(name_rect[0], time_rect[0])
+    top   = min(name_rect[1], time_rect[1])
+    right = max(name_rect[2], time_rect[2])
+    bottom= max(name_rect[3], time_rect[3])
+    return left, top, right - left, bottom - top
+
+def read_name(name_frame):
+    """OCR the name box of a frame. Returns (name_raw, name)."""
     # Turns out an enlargment significantly helps the readability of the frames
 
     # To get the NAME from the image.
@@ -688,7 +707,375 @@ def read_image(image, name_hook = None, time_hook = None):
         logging.error("Could not put name reader back in pool.")
 
     # Smart read name.
-    name = smart_read_name(name_raw)
+    return name_raw, smart_read_name(name_raw)
+
+def read_time(time_frame):
+    """OCR the time box of a frame. Returns (time_raw, time_ext, time)."""
+    # The digit reader is far faster than tesseract, so try it first.
+    if DIGIT_READER:
+        time_text = DIGITS.read(time_frame)
+        if time_text is not None:
+            return time_text, time_text, smart_read_time(time_text, time_text)
+
+    # Enlarge the frames and to the extraction.
+    time_image     = Image.fromarray(
+        enlarge(time_frame,               REG_TIME_ENLARGE))
+    try:
+        time_ext_image = Image.fromarray(
+            enlarge(extract_image(time_frame),EXT_TIME_ENLARGE))
+    except TypeError:
+        # Rarely, this can fail when there are no contour lines found.
+        # The extracted just should be the same.
+        logging.error("Image Extraction failed with error %r." % sys.exc_info()[1])
+        time_ext_image = time_image
+
+    read_time = TIME_POOL.get()
+    # Remove unicode if present.
+    time_raw  = str(read_time(time_image))
+    time_ext  = str(read_time(time_ext_image))
+    try:
+        TIME_POOL.put_nowait(read_time)
+    except queue.Full:
+        logging.error("Could not put time reader back in pool.")
+
+    time = smart_read_time(time_raw, time_ext)
+
+    # When both readings agree, teach the digit reader what these digits
+    # look like.
+    if DIGIT_READER and time and time_raw.strip() == time_ext.strip() == time:
+        DIGITS.learn(time_frame, time)
+
+    return time_raw, time_ext, time
+
+# Digit reader.
+# The timer is at most 3 digits in one font at one place, so there is no need
+# for all of tesseract. Digit_Reader cuts the time box into glyphs and
+# compares each against an average image of each digit, all at once with one
+# matrix product. The averages are learned from readings that tesseract got
+# right, so until a digit has been seen DIGIT_MIN_SAMPLES times, or whenever
+# a match is not clear, tesseract is still used.
+DIGIT_READER = True
+DIGIT_SIZE = (8, 12)     # (width, height) each glyph is scaled to.
+DIGIT_MIN_SCORE = .85    # Least correlation with the best digit.
+DIGIT_MIN_MARGIN = .05   # Least lead of the best digit over the next best.
+DIGIT_MIN_SAMPLES = 3    # Readings of a digit needed before it is used.
+
+class Digit_Reader(object):
+    """Digit_Reader() reads the match timer by template matching.
+       read(time_frame) gives the digits or None, learn(time_frame, text)
+       adds a known reading to the templates."""
+    def __init__(self):
+        size = DIGIT_SIZE[0] * DIGIT_SIZE[1]
+        self.sums = np.zeros((10, size))
+        self.counts = np.zeros(10, int)
+        # Normalized templates, one row per digit. Zero rows never match.
+        self.templates = np.zeros((10, size))
+        self.lock = threading.Lock()
+        self.stats = {"read": 0, "unsure": 0, "learned": 0}
+
+    @staticmethod
+    def segment(time_frame):
+        """Cut the time box into glyphs. Returns an array with one
+           normalized (zero mean, unit length) row per glyph, or None."""
+        if time_frame.ndim == 3:
+            gray = cv2.cvtColor(time_frame, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = time_frame
+        _, binary = cv2.threshold(gray, 0, 255,
+                                  cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        # The digits are whichever color there is less of.
+        if np.count_nonzero(binary) * 2 > binary.size:
+            binary = 255 - binary
+
+        # Glyphs are runs of columns with something in them.
+        columns = binary.any(axis = 0).astype(np.int8)
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], columns, [0]))))
+        glyphs = []
+        for left, right in zip(edges[::2], edges[1::2]):
+            glyph = binary[:, left : right]
+            rows = np.flatnonzero(glyph.any(axis = 1))
+            if rows[-1] - rows[0] + 1 < gray.shape[0] // 3:
+                continue # Too short to be a digit, just a speck.
+            glyph = glyph[rows[0] : rows[-1] + 1]
+            glyphs.append(cv2.resize(glyph, DIGIT_SIZE,
+                                     interpolation = cv2.INTER_AREA).ravel())
+
+        if not glyphs or len(glyphs) > 3:
+            return None
+        glyphs = np.array(glyphs, np.float64)
+        glyphs -= glyphs.mean(axis = 1)[:, None]
+        norms = np.linalg.norm(glyphs, axis = 1)
+        if not norms.all():
+            return None # A solid block, not a digit.
+        return glyphs / norms[:, None]
+
+    def read(self, time_frame):
+        """Read the digits in the time box. Returns None if not sure."""
+        glyphs = self.segment(time_frame)
+        if glyphs is None:
+            return None
+        # Correlation of every glyph with every digit at once.
+        scores = glyphs.dot(self.templates.T)
+        scores[:, self.counts < DIGIT_MIN_SAMPLES] = -1
+        order = np.argsort(scores, axis = 1)
+        best, second = order[:, -1], order[:, -2]
+        rows = np.arange(len(glyphs))
+        best_scores = scores[rows, best]
+        if best_scores.min() < DIGIT_MIN_SCORE or \
+           (best_scores - scores[rows, second]).min() < DIGIT_MIN_MARGIN:
+            self.stats["unsure"] += 1
+            return None
+        self.stats["read"] += 1
+        return "".join(str(digit) for digit in best)
+
+    def learn(self, time_frame, text):
+        """Add the glyphs of a time box known to read text to the templates."""
+        glyphs = self.segment(time_frame)
+        if glyphs is None or len(glyphs) != len(text) or not text.isdigit():
+            return False
+        with self.lock:
+            for glyph, digit in zip(glyphs, text):
+                digit = int(digit)
+                self.sums[digit] += glyph
+                self.counts[digit] += 1
+                template = self.sums[digit] - self.sums[digit].mean()
+                norm = np.linalg.norm(template)
+                if norm:
+                    self.templates[digit] = template / norm
+            self.stats["learned"] += 1
+        return True
+
+DIGITS = Digit_Reader()
+
+# Scoreboard pre-filter.
+# Most of an event video is pits, ceremonies and breaks with no scoreboard.
+# The name box of the scoreboard is text on a flat colored bar, so the pixels
+# along its edges are close to one color while the text inside gives a lot of
+# contrast. A frame without both can't have a scoreboard and is not worth
+# sending to the OCR. This costs a few microseconds on the tiny name box.
+# The thresholds are a first guess. test_process_frames checks them on
+# synthetic name boxes, but they have not been checked against real event
+# footage, so the filter is off until they have. To check them, scan a
+# recorded event with it on and off and compare the matches found.
+OVERLAY_FILTER = False
+OVERLAY_MAX_EDGE_STD = 24.  # Most spread of the gray levels along the edges.
+OVERLAY_MIN_CONTRAST = 48.  # Least range of gray levels inside the box.
+
+# How many frames were checked and how many skipped the OCR.
+OVERLAY_STATS = {"checked": 0, "skipped": 0}
+
+def overlay_present(name_frame):
+    """Guess, very quickly, if the scoreboard is on the frame from its name
+       box. False means it is certainly not worth the OCR."""
+    if name_frame.ndim == 3:
+        gray = cv2.cvtColor(name_frame, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = name_frame
+    edges = np.concatenate((gray[0], gray[-1], gray[1:-1, 0], gray[1:-1, -1]))
+
+    present = (edges.std() <= OVERLAY_MAX_EDGE_STD and
+               int(gray.max()) - int(gray.min()) >= OVERLAY_MIN_CONTRAST)
+
+    OVERLAY_STATS["checked"] += 1
+    if not present:
+        OVERLAY_STATS["skipped"] += 1
+    return present
+
+def overlay_hit_rate():
+    """The fraction of the checked frames that skipped the OCR."""
+    if not OVERLAY_STATS["checked"]:
+        return 0.
+    return float(OVERLAY_STATS["skipped"]) / OVERLAY_STATS["checked"]
+
+# OCR result cache.
+# Within a match the name box is the same, pixel for pixel, for thousands of
+# frames and the time box for a second at a time. So the results of the OCR
+# are kept by a fingerprint of the box, a hash of its pixels with the lowest
+# OCR_CACHE_DROP_BITS of each ignored to allow for a little noise.
+OCR_CACHE = True
+OCR_CACHE_SIZE = 256      # Results kept for each of the name and time.
+OCR_CACHE_DROP_BITS = 2
+
+class ROI_Cache(object):
+    """ROI_Cache(size = OCR_CACHE_SIZE, drop_bits = OCR_CACHE_DROP_BITS)
+       A least recently used cache of OCR results by box fingerprint.
+       stats counts the hits, misses and evictions."""
+    def __init__(self, size = OCR_CACHE_SIZE, drop_bits = OCR_CACHE_DROP_BITS):
+        self.size = size
+        self.drop_bits = drop_bits
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fingerprint(self, image):
+        """Get the key for an image."""
+        data = np.ascontiguousarray(image)
+        if self.drop_bits:
+            data = data >> self.drop_bits
+        return image.shape, hashlib.md5(data).digest()
+
+    def get(self, key):
+        """Get the result for key, or None."""
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.stats["misses"] += 1
+                return None
+            self.entries[key] = value # Now the most recently used.
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        """Save the result for key, dropping the least recently used."""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        """Forget everything."""
+        with self.lock:
+            self.entries.clear()
+
+NAME_CACHE = ROI_Cache()
+TIME_CACHE = ROI_Cache()
+
+def cached_read(cache, frame, reader):
+    """Get reader(frame) from cache, or run it and save it there."""
+    if not OCR_CACHE:
+        return reader(frame)
+    key = cache.fingerprint(frame)
+    result = cache.get(key)
+    if result is None:
+        result = reader(frame)
+        cache.put(key, result)
+    return result
+
+# Delta gating.
+# Frames next to each other almost always have the same name box. A
+# Frame_Stream remembers the name box it last read and its reading. If the
+# new box is within DELTA_THRESHOLD (mean absolute difference of gray levels)
+# of the remembered one, the old reading is used again without any OCR.
+# The time box is always read: one changed digit is only a few pixels of it
+# and could stay under the threshold. A stream is only for frames next to
+# each other, reset it before jumping anywhere else.
+DELTA_THRESHOLD = 3.0
+
+class Frame_Stream(object):
+    """Frame_Stream(threshold = DELTA_THRESHOLD)
+       The state of one stream of frames for read_image. Use
+       stream.read_image(frame) (or read_image(frame, stream = stream)) for
+       each frame in order. stats counts the reused readings."""
+    def __init__(self, threshold = None):
+        if threshold is None:
+            threshold = DELTA_THRESHOLD
+        self.threshold = threshold
+        self.last = {} # box name -> (gray box, reading)
+        self.stats = {"name_reused": 0, "name_read": 0}
+
+    @staticmethod
+    def gray(frame):
+        """Make the gray copy of a box that is compared."""
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame.astype(np.int16) # So the difference can go negative.
+
+    def reuse(self, box, gray):
+        """Get the last reading of box if gray has not changed, or None."""
+        last = self.last.get(box)
+        if last is not None and last[0].shape == gray.shape and \
+           np.abs(gray - last[0]).mean() < self.threshold:
+            self.stats[box + "_reused"] += 1
+            return last[1]
+        return None
+
+    def remember(self, box, gray, reading):
+        """Keep a new reading of box."""
+        self.stats[box + "_read"] += 1
+        self.last[box] = gray, reading
+
+    def reset(self):
+        """Forget the last frame, like after a seek."""
+        self.last.clear()
+
+    def read_image(self, image, **options):
+        """read_image with this stream."""
+        return read_image(image, stream = self, **options)
+
+def read_image(image, name_hook = None, time_hook = None,
+               frame_size = None, offset = (0, 0), stream = None):
+    """Take image files and try to read the words from them.
+       Takes a numpy image.
+       name_hook, and time_hook should be functions that are called with the
+       values for name and hook, preprocessed and postprocessed.
+       If image is only part of a frame (see scoreboard_roi), frame_size is
+       the (width, height) of the whole frame and offset is the (x, y) of
+       image in the frame.
+       stream is a Frame_Stream to skip the OCR of a name box that has not
+       changed since the last frame of that stream.
+    """
+    assert not NAME_POOL.empty(), "process_frames.NAME_POOL not initalized."
+    assert not TIME_POOL.empty(), "process_frames.TIME_POOL not initalized."
+
+    # Verify this is a valid image.
+    if not is_numpy_image(image):
+        # Error, bad image.
+        raise TypeError("Image should have been a numpy array, not %r." % image)
+
+    # Extract the 2 portions with information.
+    # Crop numpy image. NOTE: its img[y: y + h, x: x + w]
+    if frame_size is None:
+        iy, ix = image.shape[:2] # Y and X sizes. There is a third argument
+        frame_size = ix, iy      # which I think is color depth?
+    ox, oy = offset
+    name_rect, time_rect = scoreboard_rects(*frame_size)
+    name_left, name_top, name_right, name_bottom = name_rect
+    time_left, time_top, time_right, time_bottom = time_rect
+
+    # Where it matters, make the box a little larger for rounding error.
+##    name_frame = image[ny : ny + nh, nx : nx + nw]
+##    time_frame = image[ty : ty + th, tx : tx + tw]
+    name_frame = image[name_top - oy : name_bottom - oy,
+                       name_left- ox : name_right - ox]
+    time_frame = image[time_top - oy : time_bottom - oy,
+                       time_left- ox : time_right - ox]
+##    del image # Its a full image in memory. Clear as fast as possible.
+
+    # For testing.
+    if DEBUG:
+        cv2.imshow("Name", name_frame)
+        cv2.imshow("Time", time_frame)
+
+    # When following a stream of frames, a box that has not changed since
+    # the last frame keeps its last reading.
+    if stream is not None:
+        name_gray = stream.gray(name_frame)
+        reused = stream.reuse("name", name_gray)
+    else:
+        reused = None
+
+    # Most frames have no scoreboard at all. Check for one before any OCR.
+    if reused is not None:
+        name_raw, name = reused
+        name = Name_Result(name.match_type, name.match_number,
+                           name.total_matches)
+    elif OVERLAY_FILTER and not overlay_present(name_frame):
+        name_raw = "NA"
+        name     = Name_Result("", None, None)
+    else:
+        # The name is the same for a whole match, it is usually cached.
+        name_raw, name = cached_read(NAME_CACHE, name_frame, read_name)
+        # A copy, the caller is allowed to change it.
+        name = Name_Result(name.match_type, name.match_number,
+                           name.total_matches)
+    if stream is not None and reused is None:
+        stream.remember("name", name_gray, (name_raw, name))
 
     if not name:
         # We are done, negative match.
@@ -697,29 +1084,8 @@ def read_image(image, name_hook = None, time_hook = None):
         time     = None
     else:
         # Otherwise, analyize time.
-        # Enlarge the frames and to the extraction.
-        time_image     = Image.fromarray(
-            enlarge(time_frame,               REG_TIME_ENLARGE))
-        try:
-            time_ext_image = Image.fromarray(
-                enlarge(extract_image(time_frame),EXT_TIME_ENLARGE))
-        except TypeError:
-            # Rarely, this can fail when there are no contour lines found.
-            # The extracted just should be the same.
-            logging.error("Image Extraction failed with error %r." % sys.exc_info()[1])
-            time_ext_image = time_image
-
-        read_time = TIME_POOL.get()
-        # Remove unicode if present.
-        time_raw  = str(read_time(time_image))
-        time_ext  = str(read_time(time_ext_image))
-        try:
-            TIME_POOL.put_nowait(read_time)
-        except queue.Full:
-            logging.error("Could not put time reader back in pool.")
-
-        time = smart_read_time(time_raw, time_ext)
-
+        time_raw, time_ext, time = cached_read(TIME_CACHE, time_frame,
+                                               read_time)
 
      # Convert time to number.
     if time is not None and time.isdigit():
@@ -737,3 +1103,88 @@ def read_image(image, name_hook = None, time_hook = None):
     logging.info("Time Read: %-13r (%-12r) -> %s" % (time_raw, time_ext, time))
 
     return name, time
+
+# Process pool.
+# tesseract and the python around it only use one core, and read_image holds
+# the GIL most of the time, so threads don't help much. Frame_Executor hands
+# frames to worker processes instead, each with its own readers from init().
+EXECUTOR_IN_FLIGHT = 4 # Frames waiting on each worker at most.
+
+def _worker_init():
+    """Set up a worker process of Frame_Executor."""
+    global DEBUG
+    DEBUG = False # No windows from the workers.
+    init()
+
+def _worker_read(args):
+    """Read one frame in a worker process. Returns ((name, time), the
+       process id, its OVERLAY_STATS so far)."""
+    image, options = args
+    return read_image(image, **options), os.getpid(), dict(OVERLAY_STATS)
+
+class _Worker_Result(object):
+    """An AsyncResult of _worker_read that only gives the (name, time) and
+       hands the stats to the Frame_Executor."""
+    def __init__(self, result, executor):
+        self.result = result
+        self.executor = executor
+
+    def ready(self):
+        return self.result.ready()
+
+    def get(self):
+        reading, pid, stats = self.result.get()
+        self.executor.worker_stats[pid] = stats
+        return reading
+
+class Frame_Executor(object):
+    """Frame_Executor(workers = None, in_flight = None)
+       Run read_image on a pool of worker processes (one per core by default).
+       At most in_flight frames are handed out at once so frames don't pile
+       up in memory, and results always come back in frame order.
+    """
+    def __init__(self, workers = None, in_flight = None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.in_flight = in_flight or self.workers * EXECUTOR_IN_FLIGHT
+        logging.info("Starting %d OCR worker processes." % self.workers)
+        self.pool = multiprocessing.Pool(self.workers, _worker_init)
+        self.worker_stats = {} # pid -> OVERLAY_STATS of that worker.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, image, **options):
+        """Start reading image. options are passed to read_image, except the
+           hooks which can not be sent to another process.
+           Returns something like a multiprocessing AsyncResult of
+           (name, time)."""
+        return _Worker_Result(
+            self.pool.apply_async(_worker_read, ((image, options),)), self)
+
+    def read_image(self, image, **options):
+        """Read image on a worker and wait for the (name, time)."""
+        return self.submit(image, **options).get()
+
+    def map(self, images, **options):
+        """Read all of images, yielding each (name, time) in order."""
+        pending = deque()
+        for image in images:
+            if len(pending) >= self.in_flight:
+                # Wait for the oldest before handing out more.
+                yield pending.popleft().get()
+            pending.append(self.submit(image, **options))
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        """Finish the work handed out and stop the workers. Their
+           OVERLAY_STATS are added to the ones here, for deinit."""
+        self.pool.close()
+        self.pool.join()
+        for stats in self.worker_stats.values():
+            for key, value in stats.items():
+                OVERLAY_STATS[key] += value
+        self.worker_stats = {}
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Keep the readings of every frame that has been read, so a video that has
+been scanned before does not need to be read again.
+
+The readings are kept in a SQLite file with one row per (video, frame). Any
+frame can be looked up on its own, in any order.
+
+Scan_Cache(path)       Open (or create) the cache at path.
+video_key(path)        The key a video is stored under.
+"""
+import os
+import sqlite3
+import hashlib
+import logging
+
+import process_frames
+
+__all__ = ["Scan_Cache", "video_key", "SCAN_CACHE_FILE"]
+
+SCAN_CACHE_FILE = "scan_cache.sqlite" # Default name in the target folder.
+SCAN_CACHE_KEY_BYTES = 1 << 20 # The key is a hash of the first MiB.
+SCAN_CACHE_TIMEOUT = 60. # Seconds to wait for another process writing.
+
+def video_key(path):
+    """The key for the video at path.
+       This is a hash of the start of the file and the file name, so the
+       video can be found again even if it was moved to another folder.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as video_file:
+        digest.update(video_file.read(SCAN_CACHE_KEY_BYTES))
+    digest.update(os.path.basename(path).encode("utf-8"))
+    return digest.hexdigest()
+
+class Scan_Cache(object):
+    """Scan_Cache(path)
+       The readings of frames of videos, stored at path. More than one
+       process can have the same file open. The file is in WAL mode, so
+       reading never waits for a writer, and every write is its own short
+       transaction, so writers only wait for each other briefly.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout = SCAN_CACHE_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS readings ("
+                        "video TEXT NOT NULL, "
+                        "frame INTEGER NOT NULL, "
+                        "match_type TEXT NOT NULL, "
+                        "match_number INTEGER, "
+                        "total_matches INTEGER, "
+                        "time INTEGER, "
+                        "PRIMARY KEY (video, frame)) WITHOUT ROWID")
+        self.db.commit()
+        self.keys = {} # path -> key
+        self.stats = {"hits": 0, "misses": 0, "writes": 0}
+
+    def key(self, video):
+        """Get the key for video, a video_loader.Video or a path."""
+        path = getattr(video, "path", video)
+        if path not in self.keys:
+            self.keys[path] = video_key(path)
+        return self.keys[path]
+
+    @staticmethod
+    def _reading(row):
+        """Turn a row back into (name, time)."""
+        match_type, match_number, total_matches, time = row
+        return (process_frames.Name_Result(match_type, match_number,
+                                           total_matches), time)
+
+    def get(self, video, frame):
+        """Get the (name, time) read at frame, or None if it was not read."""
+        row = self.db.execute("SELECT match_type, match_number, total_matches, "
+                              "time FROM readings WHERE video = ? AND "
+                              "frame = ?", (self.key(video), int(frame))
+                              ).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return self._reading(row)
+
+    def get_range(self, video, start, stop):
+        """Get {frame: (name, time)} for the frames read in [start, stop)."""
+        rows = self.db.execute("SELECT frame, match_type, match_number, "
+                               "total_matches, time FROM readings WHERE "
+                               "video = ? AND frame >= ? AND frame < ?",
+                               (self.key(video), int(start), int(stop)))
+        readings = dict((row[0], self._reading(row[1:])) for row in rows)
+        self.stats["hits"] += len(readings)
+        self.stats["misses"] += max(int(stop) - int(start) - len(readings), 0)
+        return readings
+
+    def put(self, video, frame, name, time):
+        """Store the (name, time) read at frame."""
+        self.put_many(video, {frame: (name, time)})
+
+    def put_many(self, video, readings):
+        """Store {frame: (name, time)} in one transaction. Nothing slow
+           happens while it is open, so other processes are not held up."""
+        key = self.key(video)
+        with self.db: # Commits at the end.
+            self.db.executemany("INSERT OR REPLACE INTO readings VALUES "
+                                "(?, ?, ?, ?, ?, ?)",
+                                [(key, int(frame), name.match_type,
+                                  name.match_number, name.total_matches,
+                                  None if time is None else int(time))
+                                 for frame, (name, time) in readings.items()])
+        self.stats["writes"] += len(readings)
+
+    def count(self, video):
+        """Number of frames of video that have been read."""
+        return self.db.execute("SELECT COUNT(*) FROM readings WHERE video = ?",
+                               (self.key(video),)).fetchone()[0]
+
+    def commit(self):
+        """Write the stored readings to disk."""
+        self.db.commit()
+
+    def close(self):
+        """Commit and close the cache."""
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
+            logging.debug("Scan cache %r: %r" % (self.path, self.stats))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.path)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Tests of extract_lib on a synthetic scoreboard crop."""
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+    import extract_lib
+except ImportError:
+    extract_lib = None
+
+def scoreboard_crop(text = "Qualification 5 of 78"):
+    """A name box like the scoreboard's: light text on a dark bar."""
+    image = np.zeros((26, 224, 3), np.uint8)
+    cv2.rectangle(image, (0, 0), (223, 25), (90, 40, 20), -1)
+    cv2.putText(image, text, (4, 18), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                (255, 255, 255), 1, cv2.LINE_AA)
+    return image
+
+@unittest.skipIf(extract_lib is None, "needs cv2 and numpy")
+class Extract_Lib_Test(unittest.TestCase):
+    def test_extract_image_repeats(self):
+        image = scoreboard_crop()
+        extracted = extract_lib.extract_image(image)
+        self.assertTrue(np.array_equal(extracted,
+                                       extract_lib.extract_image(image)))
+
+    def test_stress_test(self):
+        self.assertEqual(extract_lib.stress_test(scoreboard_crop(),
+                                                 threads = 4, rounds = 5), 0)
+
+    def test_stress_test_noise(self):
+        # Noise makes the most contours, the worst case for the threads.
+        random = np.random.RandomState(0)
+        crop = random.randint(0, 256, (13, 28, 3)).astype(np.uint8)
+        self.assertEqual(extract_lib.stress_test(crop, threads = 4,
+                                                 rounds = 5), 0)
+
+if __name__ == "__main__":
+    unittest.main()
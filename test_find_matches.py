@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""Tests of find_matches on a fake video with a perfect reader."""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+    import find_matches
+    import process_frames
+    import scan_cache
+except ImportError:
+    find_matches = None
+
+FPS = 30.
+
+class Fake_Video(object):
+    """A video whose frames are their own numbers. matches is a list of
+       (name, first frame, last frame) showing the scoreboard."""
+    name = "fake.mp4"
+    path = "fake.mp4"
+
+    def __init__(self, matches, frame_count):
+        self.matches = matches
+        self.frame_count = frame_count
+        self.reads = 0
+
+    def get_fps(self):
+        return FPS
+
+    def get_frame_count(self):
+        return self.frame_count
+
+    def get_roi(self):
+        return None
+
+    def read_burst(self, center_index, count):
+        start = max(int(center_index) - count // 2, 0)
+        self.reads += 1
+        return list(range(start, min(start + count, self.frame_count)))
+
+    def iter_sampled(self, indices, burst, skip = None):
+        for index in sorted(indices):
+            if skip is not None and skip(index):
+                yield index, index * 1000. / FPS, None
+                continue
+            frames = self.read_burst(index, burst)
+            if not frames:
+                break
+            yield index, index * 1000. / FPS, frames
+
+    def reading(self, frame):
+        """What a perfect reader sees on frame. The timer ticks every
+           second, the total is misread on some frames."""
+        for name, first, last in self.matches:
+            if first <= frame <= last:
+                total = 78 if frame % 97 else 87
+                return (process_frames.Name_Result(name.match_type,
+                                                   name.match_number, total),
+                        int((frame - first) / FPS) + 1)
+        return process_frames.Name_Result('', None, None), None
+
+class Fake_Result(object):
+    def __init__(self, executor, reading):
+        self.executor = executor
+        self.reading = reading
+
+    def get(self):
+        self.executor.waiting -= 1
+        return self.reading
+
+class Fake_Executor(object):
+    """Reads the frames of a Fake_Video, like a Frame_Executor. waiting is
+       how many submitted frames have not been taken back yet."""
+    def __init__(self, video, in_flight = 20):
+        self.video = video
+        self.in_flight = in_flight
+        self.waiting = 0
+        self.most_waiting = 0
+
+    def submit(self, image, **options):
+        self.waiting += 1
+        self.most_waiting = max(self.most_waiting, self.waiting)
+        return Fake_Result(self, self.video.reading(image))
+
+    def read_image(self, image, **options):
+        return self.submit(image, **options).get()
+
+def fake_event(count = 10, gap = 37.3):
+    """A Fake_Video of count qualification matches with gap seconds (and
+       some odd frames) between them."""
+    matches = []
+    frame = int(11.1 * FPS)
+    for number in range(1, count + 1):
+        name = process_frames.Name_Result("q2", number, 78)
+        length = int(find_matches.MATCH_LENGTH * FPS) - number * 13
+        matches.append((name, frame, frame + length - 1))
+        frame += length + int(gap * FPS) + number * 17
+    return Fake_Video(matches, frame)
+
+@unittest.skipIf(find_matches is None, "needs the OCR dependencies")
+class Refine_Matches_Test(unittest.TestCase):
+    def setUp(self):
+        self.verbose = find_matches.VERBOSE, find_matches.SHOW_VISUAL
+        find_matches.VERBOSE, find_matches.SHOW_VISUAL = 0, False
+
+    def tearDown(self):
+        find_matches.VERBOSE, find_matches.SHOW_VISUAL = self.verbose
+
+    def test_edges(self):
+        video = fake_event()
+        executor = Fake_Executor(video)
+        step = int(find_matches.MATCH_LENGTH / 7. * FPS)
+        results = find_matches.homogenize_totals(find_matches.scan_range(
+            video, list(range(0, video.frame_count, step)), None, executor))
+        timings = find_matches.refine_matches(video, results, None, executor)
+
+        self.assertEqual(len(timings), len(video.matches))
+        # The moment around a frame only agrees a few frames inside a match.
+        slack = find_matches.MOMENT_MINIMUM_FRAMES
+        for (name, start, stop), (match, first, last) in \
+                zip(sorted(timings, key = lambda timing: timing[1]),
+                    video.matches):
+            self.assertTrue(find_matches.same_match(name, match))
+            self.assertLessEqual(abs(start * FPS - first), slack)
+            self.assertLessEqual(abs(stop * FPS - (last + 1)), slack)
+
+@unittest.skipIf(find_matches is None, "needs the OCR dependencies")
+class Scan_Range_Test(unittest.TestCase):
+    def setUp(self):
+        self.verbose = find_matches.VERBOSE, find_matches.SHOW_VISUAL
+        find_matches.VERBOSE, find_matches.SHOW_VISUAL = 0, False
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def tearDown(self):
+        find_matches.VERBOSE, find_matches.SHOW_VISUAL = self.verbose
+
+    def test_cached_rescan(self):
+        # A second scan takes every moment from the cache, decoding nothing.
+        video = fake_event(3)
+        video.path = os.path.join(self.folder, video.name)
+        with open(video.path, "wb") as video_file:
+            video_file.write(b"frames")
+        cache = scan_cache.Scan_Cache(os.path.join(self.folder, "cache"))
+        self.addCleanup(cache.close)
+        indices = list(range(0, video.frame_count, 1000))
+
+        results = find_matches.scan_range(video, indices, cache,
+                                          Fake_Executor(video))
+        # A burst for each moment, and more frames where the name is blank.
+        self.assertGreaterEqual(video.reads, len(indices))
+        video.reads = 0
+        self.assertEqual(find_matches.scan_range(video, indices, cache,
+                                                 Fake_Executor(video)),
+                         results)
+        self.assertEqual(video.reads, 0)
+
+    def test_executor_fed(self):
+        # The bursts of the next moments go out before the first is voted on.
+        video = fake_event(3)
+        indices = list(range(0, video.frame_count, 1000))
+        executor = Fake_Executor(video)
+        results = find_matches.scan_range(video, indices, None, executor)
+        self.assertEqual(executor.waiting, 0)
+        self.assertEqual(executor.most_waiting, executor.in_flight)
+        # Just the same as reading them one moment at a time.
+        video = fake_event(3)
+        self.assertEqual(find_matches.scan_range(video, indices, None,
+                                                 Fake_Executor(video, 1)),
+                         results)
+
+class Level_Reader(object):
+    """A perfect reader of the frames of write_event, for a Fake_Executor."""
+    @staticmethod
+    def reading(frame):
+        number = int(round(frame[..., 0].mean() / 40.))
+        if number:
+            return process_frames.Name_Result("q2", number, 78), None
+        return process_frames.Name_Result('', None, None), None
+
+def write_event(path, matches, frame_count, fps = 2.):
+    """Write a small lossless video of the matches, (number, first frame,
+       last frame), with each frame of one a flat gray level of 40 times
+       its number and every other frame black."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"FFV1"), fps,
+                             (16, 16))
+    for frame in range(frame_count):
+        level = 0
+        for number, first, last in matches:
+            if first <= frame <= last:
+                level = number * 40
+        writer.write(np.full((16, 16, 3), level, np.uint8))
+    writer.release()
+    return path
+
+@unittest.skipIf(find_matches is None, "needs the OCR dependencies")
+class Stream_Matches_Test(unittest.TestCase):
+    FPS = 2.
+    MATCHES = [(1, 80, 600), (2, 680, 1190)]
+    FRAMES = 1280
+
+    def setUp(self):
+        self.settings = (find_matches.VERBOSE, find_matches.SHOW_VISUAL,
+                         find_matches.SCAN_ROI)
+        find_matches.VERBOSE, find_matches.SHOW_VISUAL = 0, False
+        find_matches.SCAN_ROI = False # The frames are too small for it.
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.path = os.path.join(folder, "match.avi")
+
+    def tearDown(self):
+        (find_matches.VERBOSE, find_matches.SHOW_VISUAL,
+         find_matches.SCAN_ROI) = self.settings
+
+    def check(self, events):
+        """events are a start and an end for each of MATCHES."""
+        slack = find_matches.MOMENT_MINIMUM_FRAMES / self.FPS
+        self.assertEqual([(event.kind, event.name.match_number)
+                          for event in events],
+                         [("start", 1), ("end", 1), ("start", 2), ("end", 2)])
+        for (start, end), (number, first, last) in \
+                zip(zip(events[::2], events[1::2]), self.MATCHES):
+            self.assertLessEqual(abs(start.time - first / self.FPS), slack)
+            self.assertLessEqual(abs(end.time - (last + 1) / self.FPS), slack)
+
+    def test_complete(self):
+        write_event(self.path, self.MATCHES, self.FRAMES, self.FPS)
+        events = list(find_matches.stream_matches(
+            self.path, executor = Fake_Executor(Level_Reader()),
+            done = lambda: True, poll = False))
+        self.check(events)
+
+    def test_growing(self):
+        # The recorder has written the first match and part of the second.
+        write_event(self.path, self.MATCHES, 900, self.FPS)
+        complete = [False]
+        matches = find_matches.stream_matches(
+            self.path, executor = Fake_Executor(Level_Reader()),
+            done = lambda: complete[0], poll = False)
+        events = []
+        for event in matches:
+            if event is None:
+                break
+            events.append(event)
+        # Only the first match is known to have ended.
+        self.assertEqual([(event.kind, event.name.match_number)
+                          for event in events],
+                         [("start", 1), ("end", 1), ("start", 2)])
+        self.assertIsNone(next(matches)) # Nothing new yet.
+
+        write_event(self.path, self.MATCHES, self.FRAMES, self.FPS)
+        complete[0] = True
+        events.extend(matches)
+        self.check(events)
+
+@unittest.skipIf(find_matches is None, "needs the OCR dependencies")
+class Find_Edge_Test(unittest.TestCase):
+    def probe(self, edge):
+        """present for an edge at frame edge, counting the probes."""
+        self.probes = []
+        def present(frame):
+            self.probes.append(frame)
+            return frame <= edge
+        return present
+
+    def test_bisect(self):
+        for edge in (0, 1, 500, 998):
+            self.assertEqual(find_matches.find_edge(self.probe(edge), 0, 999),
+                             edge)
+
+    def test_backwards(self):
+        # The start of something that goes on to frame 999.
+        for guess in (None, 480, 520):
+            self.assertEqual(find_matches.find_edge(
+                lambda frame: frame >= 501, 999, 0, guess), 501)
+
+    def test_gallop(self):
+        for guess in (495, 500, 505):
+            edge = find_matches.find_edge(self.probe(500), 0, 100000, guess)
+            self.assertEqual(edge, 500)
+            # Far fewer than the 17 probes of bisecting it all.
+            self.assertLessEqual(len(self.probes), 8)
+
+    def test_bad_guess(self):
+        # A guess outside the range is not used.
+        for guess in (-5, 0, 1000, 2000):
+            self.assertEqual(find_matches.find_edge(self.probe(321), 0, 1000,
+                                                    guess), 321)
+
+@unittest.skipIf(find_matches is None, "needs the OCR dependencies")
+class Match_Tracker_Test(unittest.TestCase):
+    def setUp(self):
+        self.tracker = find_matches._Match_Tracker(1.)
+        self.one = process_frames.Name_Result("q2", 1, 78)
+        self.two = process_frames.Name_Result("q2", 2, 78)
+        self.blank = process_frames.Name_Result('', None, None)
+
+    @staticmethod
+    def locate(name, inside, outside, guess):
+        """The edge is at the sample with the match."""
+        return inside
+
+    def feed(self, names, step = 10):
+        """Sample names step frames apart. Returns the events as
+           (kind, match_number, time)."""
+        events = []
+        for number, name in enumerate(names):
+            events.extend(self.tracker.sample(number * step, name, None,
+                                              self.locate))
+        events.extend(self.tracker.finish(len(names) * step, self.locate))
+        return [(event.kind, event.name.match_number, event.time)
+                for event in events]
+
+    def test_one_match(self):
+        self.assertEqual(self.feed([self.blank, self.one, self.one,
+                                    self.blank, self.blank]),
+                         [("start", 1, 10.), ("end", 1, 21.)])
+
+    def test_misread_sample(self):
+        # One blank or wrong sample does not split the match.
+        for misread in (self.blank, self.two):
+            self.setUp()
+            self.assertEqual(self.feed([self.one, misread, self.one,
+                                        self.blank, self.blank]),
+                             [("start", 1, 0.), ("end", 1, 21.)])
+
+    def test_total_misread(self):
+        other_total = process_frames.Name_Result("q2", 1, 87)
+        self.assertEqual(self.feed([self.one, other_total, self.one]),
+                         [("start", 1, 0.), ("end", 1, 21.)])
+
+    def test_next_match(self):
+        self.assertEqual(self.feed([self.one, self.one, self.two, self.two]),
+                         [("start", 1, 0.), ("end", 1, 11.),
+                          ("start", 2, 20.), ("end", 2, 31.)])
+
+    def test_finish_pending(self):
+        # The video ends with a sample that does not have the match.
+        self.assertEqual(self.feed([self.one, self.blank]),
+                         [("start", 1, 0.), ("end", 1, 1.)])
+        self.setUp()
+        self.assertEqual(self.feed([self.one, self.two]),
+                         [("start", 1, 0.), ("end", 1, 1.),
+                          ("start", 2, 10.), ("end", 2, 11.)])
+
+    def test_finish_current(self):
+        self.assertEqual(self.feed([self.blank, self.one]),
+                         [("start", 1, 10.), ("end", 1, 11.)])
+        self.assertEqual(self.tracker.finish(100, self.locate), [])
+
+if __name__ == "__main__":
+    unittest.main()
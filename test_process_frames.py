@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tests of the process_frames scoreboard pre-filter on synthetic crops."""
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+    import process_frames
+except ImportError:
+    process_frames = None
+
+def name_crop(width, height, bar = (90, 40, 20),
+              text = "Qualification 5 of 78"):
+    """The name box of a width x height frame. Light text on a flat bar like
+       the scoreboard's, or just the bar if text is None."""
+    (left, top, right, bottom), time_rect = \
+        process_frames.scoreboard_rects(width, height)
+    image = np.zeros((bottom - top, right - left, 3), np.uint8)
+    image[:] = bar
+    if text is not None:
+        scale = image.shape[0] / 50.
+        cv2.putText(image, text, (image.shape[1] // 50,
+                                  image.shape[0] * 2 // 3),
+                    cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255),
+                    max(int(scale * 2), 1), cv2.LINE_AA)
+    return image
+
+SIZES = (854, 480), (1280, 720), (1920, 1080)
+
+@unittest.skipIf(process_frames is None, "needs cv2 and numpy")
+class Overlay_Present_Test(unittest.TestCase):
+    def setUp(self):
+        self.stats = dict(process_frames.OVERLAY_STATS)
+        self.addCleanup(process_frames.OVERLAY_STATS.update, self.stats)
+
+    def test_scoreboard(self):
+        for size in SIZES:
+            for bar in ((90, 40, 20), (20, 20, 160), (40, 40, 40)):
+                crop = name_crop(*size, bar = bar)
+                self.assertTrue(process_frames.overlay_present(crop),
+                                (size, bar))
+                gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+                self.assertTrue(process_frames.overlay_present(gray))
+
+    def test_empty(self):
+        random = np.random.RandomState(0)
+        for size in SIZES:
+            crop = name_crop(*size, text = None)
+            shape = crop.shape
+            gradient = np.linspace(0, 255, shape[1]).astype(np.uint8)
+            for empty in (np.zeros(shape, np.uint8), # Black between matches.
+                          crop,                      # The bar without text.
+                          np.broadcast_to(gradient[None, :, None], shape),
+                          random.randint(0, 256, shape).astype(np.uint8)):
+                self.assertFalse(process_frames.overlay_present(empty), size)
+
+    def test_stats(self):
+        process_frames.OVERLAY_STATS.update(checked = 0, skipped = 0)
+        process_frames.overlay_present(name_crop(1280, 720))
+        process_frames.overlay_present(name_crop(1280, 720, text = None))
+        self.assertEqual(process_frames.OVERLAY_STATS,
+                         {"checked": 2, "skipped": 1})
+        self.assertEqual(process_frames.overlay_hit_rate(), .5)
+
+if __name__ == "__main__":
+    unittest.main()
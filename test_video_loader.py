@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Tests of video_loader.Video on a small synthetic video."""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+    import video_loader
+except ImportError:
+    video_loader = None
+
+def write_video(path, frame_count = 90, size = (64, 48), fps = 30.):
+    """Write a lossless video whose frames are each one flat gray level, 2
+       apart."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"FFV1"), fps, size)
+    for frame in range(frame_count):
+        writer.write(np.full((size[1], size[0], 3), frame * 2 % 256, np.uint8))
+    writer.release()
+    return path
+
+def level(frame):
+    """The frame number of a frame from write_video."""
+    return int(round(frame[..., 0].mean() / 2.))
+
+@unittest.skipIf(video_loader is None, "needs cv2 and numpy")
+class Video_Test(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.path = write_video(os.path.join(folder, "match.avi"))
+
+    def video(self, **options):
+        video = video_loader.Video(self.path, keyframe_index = False,
+                                   **options)
+        self.addCleanup(video.close)
+        return video
+
+    def test_prefetch(self):
+        frames = [level(frame) for frame in self.video(prefetch = 4)]
+        self.assertEqual(frames, list(range(90)))
+
+    def test_prefetch_error(self):
+        # A failed read on the decoder thread is raised by the reader.
+        video = self.video()
+        reads = []
+        def broken_read(read = video._cap_read):
+            reads.append(None)
+            if len(reads) > 10:
+                raise IOError("Disk went away.")
+            return read()
+        video._cap_read = broken_read
+        video.start_prefetch(4)
+        for frame in range(10):
+            self.assertEqual(level(video.get_frame()), frame)
+        self.assertRaises(IOError, video.get_frame)
+        self.assertIsNone(video.get_frame())
+
+    def test_read_burst(self):
+        frames = self.video().read_burst(40, 5)
+        self.assertEqual(frames.shape, (5, 48, 64, 3))
+        self.assertEqual([level(frame) for frame in frames],
+                         [38, 39, 40, 41, 42])
+        # Short at the end.
+        self.assertEqual(len(self.video().read_burst(88, 5)), 4)
+
+    def test_read_burst_roi(self):
+        video = self.video()
+        self.assertEqual(video.read_burst(40, 3, (10, 5, 20, 30)).shape,
+                         (3, 30, 20, 3))
+        # Clipped to the video's own region of interest.
+        video.set_roi((8, 4, 32, 24))
+        self.assertEqual(video.read_burst(50, 3, (10, 5, 20, 30)).shape,
+                         (3, 23, 20, 3))
+        self.assertEqual(video.read_burst(60, 3, (0, 0, 64, 48)).shape,
+                         (3, 24, 32, 3))
+        self.assertRaises(ValueError, video.read_burst, 70, 3, (50, 5, 8, 8))
+
+if __name__ == "__main__":
+    unittest.main()
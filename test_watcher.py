@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Tests of watcher.Folder_Watcher, with polling on a temporary folder."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import watcher
+
+class Folder_Watcher_Test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def watcher(self):
+        """A polling Folder_Watcher of the folder that settles quickly."""
+        folder_watcher = watcher.Folder_Watcher(
+            [self.folder], poll = 0.01, settle = 0.1, use_inotify = False)
+        self.addCleanup(folder_watcher.close)
+        return folder_watcher
+
+    def write(self, name, data, mode = "wb"):
+        path = os.path.join(self.folder, name)
+        with open(path, mode) as out_file:
+            out_file.write(data)
+        return path
+
+    def test_new_file_completes(self):
+        path = self.write("match.mp4", b"frames")
+        changes = list(self.watcher().changes(idle_exit = 0.3))
+        self.assertEqual(changes, [(path, False), (path, True)])
+
+    def test_growing_file(self):
+        changes = self.watcher().changes()
+        path = self.write("match.mp4", b"frames")
+        self.assertEqual(next(changes), (path, False))
+        self.write("match.mp4", b"more frames", "ab")
+        self.assertEqual(next(changes), (path, False))
+        self.assertEqual(next(changes), (path, True))
+
+    def test_changed_after_complete(self):
+        changes = self.watcher().changes()
+        path = self.write("match.mp4", b"frames")
+        self.assertEqual(next(changes), (path, False))
+        self.assertEqual(next(changes), (path, True))
+        self.write("match.mp4", b"more frames", "ab")
+        self.assertEqual(next(changes), (path, False))
+        self.assertEqual(next(changes), (path, True))
+
+    def test_idle_exit(self):
+        self.assertEqual(list(self.watcher().changes(idle_exit = 0.05)), [])
+
+    def test_ignores_folders(self):
+        os.mkdir(os.path.join(self.folder, "clips"))
+        self.assertEqual(list(self.watcher().changes(idle_exit = 0.05)), [])
+
+if __name__ == "__main__":
+    unittest.main()
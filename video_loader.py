@@ -4,17 +4,28 @@ Use a video library to get, edit, and save video.
 The api for this library is as follows.
 
 Video(source)
+FFmpeg_Video(source)    Same api, decoded by an ffmpeg subprocess.
+open_video(source, backend)
+Keyframe_Index.for_video(path)
 
 """
 __author__ = "Matthew Schweiss"
 __version__ = "0.5"
 # TODO
 # Add the meanings of various return codes.
-__all__ = ["Video", "load_image", "save_image", "show_image", "close_image"]
+__all__ = ["Video", "FFmpeg_Video", "Keyframe_Index", "open_video",
+           "probe_video", "load_image", "save_image", "show_image",
+           "close_image"]
 
 import os
+import sys
+import json
+import time
+import bisect
 import logging
 import warnings
+import threading
+import subprocess
 # Get whatever library is avalible.
 
 try:
@@ -29,8 +40,36 @@ except NameError:
 # So don't bother the redundancy.
 
 import cv2
+import numpy as np
 #import ffmpeg
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Number of frames decoded ahead of the reader when prefetching is turned on
+# without a specific depth.
+PREFETCH_DEPTH = 16
+
+# Keyframe index settings.
+# If KEYFRAME_INDEX is True, a Video without an index saved next to it builds
+# one with ffprobe on its first seek. That reads every packet of the file
+# (but decodes nothing), so it is not done when the Video is opened and a
+# video that is only read straight through never pays for it.
+KEYFRAME_INDEX = True
+KEYFRAME_INDEX_EXTENSION = ".keyframes.json"
+FFPROBE = "ffprobe"
+# About how many frames could be grabbed in the time a seek takes. Seeking is
+# only done when it saves more than this many grabs.
+SEEK_COST_FRAMES = 12
+
+# ffmpeg backend settings.
+FFMPEG = "ffmpeg"
+# Frames handed out by FFmpeg_Video live in a ring of this many reused
+# buffers, so a frame is only good until this many more frames are read.
+FFMPEG_BUFFERS = 16
+
 def load_image(path):
     """Load the image from file."""
     # First make sure the source exists.
@@ -75,6 +114,143 @@ def close_image(image = None):
         raise RuntimeError("Image must be the name of a window displaying"
                            " or None, not %r." % image)
 
+class Keyframe_Index(object):
+    """The frame numbers, timestamps and byte offsets of the keyframes in a
+       video. Built with ffprobe and saved next to the video.
+
+       Decoding can only start at a keyframe, so a seek to any frame has to
+       decode from the keyframe before it. Knowing where the keyframes are
+       lets Video pick between seeking and just grabbing forward.
+    """
+    __slots__ = ('frames', 'timestamps', 'offsets', 'size', 'mtime')
+
+    def __init__(self, frames, timestamps, offsets, size = None, mtime = None):
+        """Keyframe_Index(frames, timestamps, offsets, size, mtime)
+           frames, timestamps (ms) and offsets (bytes) are sorted lists.
+           size and mtime are of the video file when the index was built.
+        """
+        if not frames:
+            raise ValueError("A keyframe index needs at least one keyframe.")
+        self.frames = list(frames)
+        self.timestamps = list(timestamps)
+        self.offsets = list(offsets)
+        self.size = size
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return "<Keyframe_Index of %d keyframes>" % len(self)
+
+    @staticmethod
+    def index_path(path):
+        """Get the path the index for the video at path is saved to."""
+        return path + KEYFRAME_INDEX_EXTENSION
+
+    @classmethod
+    def build(cls, path):
+        """Build the index of the video at path by reading its packets with
+           ffprobe. Nothing is decoded, but the whole file is read."""
+        stat = os.stat(path)
+        command = [FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                   '-show_entries', 'packet=pts_time,pos,flags',
+                   '-of', 'compact=p=0', path]
+        logging.debug(subprocess.list2cmdline(command))
+        output = subprocess.check_output(command)
+
+        # Packets come in decode order, frames are counted in display order.
+        packets = []
+        for line in output.decode(errors = 'replace').splitlines():
+            # Each line looks like "pts_time=1.001000|pos=4096|flags=K_"
+            fields = dict(field.partition('=')[::2]
+                          for field in line.strip().split('|'))
+            try:
+                pts = float(fields['pts_time'])
+            except (KeyError, ValueError):
+                continue # No timestamp (N/A), can't place it.
+            try:
+                pos = int(fields.get('pos'))
+            except (TypeError, ValueError):
+                pos = -1
+            packets.append((pts, pos, 'K' in fields.get('flags', '')))
+        packets.sort()
+
+        frames, timestamps, offsets = [], [], []
+        for frame, (pts, pos, key) in enumerate(packets):
+            if key:
+                frames.append(frame)
+                timestamps.append(pts * 1000.)
+                offsets.append(pos)
+        if not frames:
+            raise ValueError("No keyframes found in %r." % path)
+        return cls(frames, timestamps, offsets, stat.st_size, stat.st_mtime)
+
+    @classmethod
+    def load(cls, path):
+        """Load the saved index for the video at path.
+           Returns None if there is none or it is out of date."""
+        index_path = cls.index_path(path)
+        try:
+            with open(index_path) as index_file:
+                data = json.load(index_file)
+            stat = os.stat(path)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get('size') != stat.st_size or \
+           data.get('mtime') != stat.st_mtime:
+            logging.debug("Keyframe index %r is out of date." % index_path)
+            return None
+        try:
+            return cls(data['frames'], data['timestamps'], data['offsets'],
+                       data['size'], data['mtime'])
+        except (KeyError, ValueError):
+            logging.error("Keyframe index %r is corrupted." % index_path)
+            return None
+
+    def save(self, path):
+        """Save the index next to the video at path."""
+        index_path = self.index_path(path)
+        with open(index_path, 'w') as index_file:
+            json.dump({'size'      : self.size,
+                       'mtime'     : self.mtime,
+                       'frames'    : self.frames,
+                       'timestamps': self.timestamps,
+                       'offsets'   : self.offsets}, index_file)
+
+    @classmethod
+    def for_video(cls, path, build = True):
+        """Load the index for the video at path, building and saving it if
+           there is not one and build is True. Returns None on failure."""
+        index = cls.load(path)
+        if index is not None or not build:
+            return index
+        try:
+            index = cls.build(path)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            # No ffprobe, or it could not read the file.
+            logging.error("Could not build keyframe index for %r: %r" %
+                          (path, sys.exc_info()[1]))
+            return None
+        try:
+            index.save(path)
+        except (IOError, OSError):
+            # Read only folder? Still use it for now.
+            logging.warning("Could not save keyframe index for %r." % path)
+        return index
+
+    def keyframe_before(self, frame):
+        """Get the (frame, timestamp, offset) of the last keyframe at or
+           before frame."""
+        i = max(bisect.bisect_right(self.frames, frame) - 1, 0)
+        return self.frames[i], self.timestamps[i], self.offsets[i]
+
+    def keyframe_before_timestamp(self, timestamp):
+        """Get the (frame, timestamp, offset) of the last keyframe at or
+           before timestamp (ms)."""
+        i = max(bisect.bisect_right(self.timestamps, timestamp) - 1, 0)
+        return self.frames[i], self.timestamps[i], self.offsets[i]
+
 class Video():
     """A wrapper class for cv2 and ffmpeg of video processing."""
 
@@ -82,8 +258,18 @@ class Video():
                'get_frame_index',   'get_frame_height', 'get_frame_width',
                'get_progress',      'get_timestamp',    'name', 'path',
                'set_frame_index',   'set_progress',     'set_timestamp',
-               'get_frame_count']
-    def __init__(self, source):
+               'get_frame_count',   'start_prefetch',   'stop_prefetch',
+               'get_prefetch_stats', 'skip_frames',    'keyframes',
+               'get_roi',           'set_roi',          'sample_indices',
+               'read_burst',        'iter_sampled']
+    def __init__(self, source, prefetch = 0, keyframe_index = None):
+        """Open the video at source.
+           If prefetch is given, that many frames are decoded ahead on a
+           background thread. (See start_prefetch.)
+           keyframe_index is a Keyframe_Index, True to load or build one,
+           False to not use one, or None to load a saved one and, if
+           KEYFRAME_INDEX, build one on the first seek.
+        """
         self.path = os.path.normpath(source)
         self.name = os.path.basename(self.path)
         self.cap = cv2.VideoCapture(self.path)
@@ -100,11 +286,63 @@ class Video():
             raise ValueError(
                 "The path %r is not a readable video file." % source)
 
+        self._init_state(keyframe_index)
+        if prefetch:
+            self.start_prefetch(prefetch)
+
+    def _init_state(self, keyframe_index):
+        """Set up everything that is not the capture itself."""
+        # Region of interest, (x, y, width, height) or None for whole frames.
+        self._roi = None
+
+        # Prefetching state. Only the decoder thread uses the capture while
+        # it is running, everything else goes through self._cap_lock.
+        self._cap_lock = threading.Lock()
+        self._prefetch_thread = None
+        self._prefetch_stats = None
+
+        # The keyframe index is used to make seeks cheaper.
+        self._build_keyframes = False
+        if keyframe_index is None:
+            # Use one if it is saved, otherwise build it when it is needed.
+            self.keyframes = Keyframe_Index.for_video(self.path, False)
+            self._build_keyframes = self.keyframes is None and KEYFRAME_INDEX
+        elif keyframe_index is True:
+            self.keyframes = Keyframe_Index.for_video(self.path)
+        elif keyframe_index is False:
+            self.keyframes = None
+        else:
+            self.keyframes = keyframe_index
+
     def __repr__(self):
-        return "Video(%r)" % self.path
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    # Backend.
+    # Everything that talks to the decoder goes through these, so another
+    # backend (see FFmpeg_Video) only has to replace them.
+    def _cap_read(self):
+        """Decode the next frame. Returns (success, frame)."""
+        return self.cap.read()
+
+    def _cap_grab(self):
+        """Move past the next frame without converting it. Returns success."""
+        return self.cap.grab()
+
+    def _cap_retrieve(self):
+        """Get the frame last grabbed. Returns (success, frame)."""
+        return self.cap.retrieve()
+
+    def _cap_get(self, prop):
+        """Get a cv2.CAP_PROP_* value."""
+        return self.cap.get(prop)
+
+    def _cap_set(self, prop, value):
+        """Set a cv2.CAP_PROP_* value. Returns a status code."""
+        return self.cap.set(prop, value)
 
     def __iter__(self):
-        """Go through the frames."""
+        """Go through the frames.
+           If prefetching is on, the frames come from the decoder thread."""
         while not self.closed():
             # Open
             frame = self.get_frame()
@@ -114,22 +352,191 @@ class Video():
         # Close cause we are done.
         self.close()
 
+    # Prefetching.
+    # The decoder thread reads frames from the capture and puts them on a bounded
+    # queue along with the position of the capture after the read. The reader
+    # takes them off in get_frame() so decoding runs while the last frame is
+    # still being processed. Seeking stops the thread, moves the capture and
+    # starts the thread again.
+    def start_prefetch(self, depth = None):
+        """Start decoding up to depth frames ahead on a background thread."""
+        if depth is None:
+            depth = PREFETCH_DEPTH
+        if depth < 1:
+            raise ValueError("Prefetch depth must be at least 1, not %r."%depth)
+        if self._prefetch_thread is not None:
+            # Already running, restart with the new depth.
+            self.stop_prefetch()
+
+        # Where the reader is, that is, where the capture was before the
+        # decoder thread started reading ahead.
+        with self._cap_lock:
+            self._position = (self._cap_get(cv2.CAP_PROP_POS_FRAMES),
+                              self._cap_get(cv2.CAP_PROP_POS_MSEC))
+        self._last_frame = None
+        self._prefetch_eof = False
+        self._prefetch_error = None # What stopped the decoder thread, if any.
+
+        if self._prefetch_stats is None or \
+           self._prefetch_stats["depth"] != depth:
+            self._prefetch_stats = {
+                "depth"          : depth,
+                "frames"         : 0,   # Frames handed to the reader.
+                "starved"        : 0,   # Reads that found the queue empty.
+                "starved_seconds": 0.0, # Time spent waiting on the decoder.
+                "full"           : 0,   # Times the decoder waited on reader.
+                "queued"         : 0,   # Sum of queue sizes seen by reads.
+                }
+
+        self._prefetch_queue = queue.Queue(depth)
+        self._prefetch_stop = threading.Event()
+        self._prefetch_thread = threading.Thread(
+            target = self._prefetch_worker,
+            args = (self._prefetch_queue, self._prefetch_stop),
+            name = "Prefetch %s" % self.name)
+        self._prefetch_thread.daemon = True # Don't hold up an exit.
+        self._prefetch_thread.start()
+
+    def stop_prefetch(self, restore = True):
+        """Stop the decoder thread.
+           If restore, the capture is moved back to the frame after the last
+           one returned, as if prefetching never happened."""
+        thread = self._prefetch_thread
+        if thread is None:
+            return
+        self._prefetch_thread = None
+        self._prefetch_stop.set()
+
+        # Empty the queue so the thread is not stuck on a put().
+        while thread.is_alive():
+            try:
+                self._prefetch_queue.get(timeout = .05)
+            except queue.Empty:
+                pass
+        thread.join()
+
+        logging.debug("Prefetch stats for %r: %r" %
+                      (self.name, self.get_prefetch_stats()))
+
+        if restore and not self.closed():
+            # The capture is ahead of the reader, put it back.
+            with self._cap_lock:
+                self._cap_set(cv2.CAP_PROP_POS_FRAMES, self._position[0])
+
+    def get_prefetch_stats(self):
+        """Get a dictionary of how well prefetching kept up with the reader.
+           "starved" is the number of reads that had to wait on the decoder,
+           "full" is the number of times the decoder had to wait on the
+           reader. Returns None if prefetching was never started."""
+        if self._prefetch_stats is None:
+            return None
+        stats = dict(self._prefetch_stats)
+        frames = stats["frames"]
+        stats["starved_ratio"] = float(stats["starved"]) / frames if frames else 0.
+        stats["mean_queued"] = float(stats.pop("queued")) / frames if frames else 0.
+        return stats
+
+    def _prefetch_worker(self, frames, stop):
+        """Decoder thread. Read frames into the queue until stopped or EOF.
+           The queue always ends with a None frame, even if reading fails,
+           and the error is kept for the reader to raise."""
+        try:
+            while not stop.is_set():
+                with self._cap_lock:
+                    ret, frame = self._cap_read()
+                    position = (self._cap_get(cv2.CAP_PROP_POS_FRAMES),
+                                self._cap_get(cv2.CAP_PROP_POS_MSEC))
+                if not ret:
+                    # End of file, nothing more to decode.
+                    break
+                # Crop here so only the region of interest sits in the queue.
+                self._prefetch_put(frames, stop, (position, self._crop(frame)))
+        except Exception:
+            self._prefetch_error = sys.exc_info()[1]
+        finally:
+            # Don't leave the reader waiting on a frame that won't come.
+            self._prefetch_put(frames, stop, (None, None))
+
+    def _prefetch_put(self, frames, stop, item):
+        """Put item on the queue, but keep checking for a stop."""
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout = .1)
+                return
+            except queue.Full:
+                self._prefetch_stats["full"] += 1
+
+    def _prefetch_get(self):
+        """Get the next frame from the decoder thread."""
+        if self._prefetch_eof:
+            return None
+        stats = self._prefetch_stats
+        try:
+            stats["queued"] += self._prefetch_queue.qsize()
+            position, frame = self._prefetch_queue.get_nowait()
+        except queue.Empty:
+            # The decoder is behind, wait for it.
+            stats["starved"] += 1
+            start = time.time()
+            position, frame = self._prefetch_queue.get()
+            stats["starved_seconds"] += time.time() - start
+
+        if frame is None:
+            # The decoder thread has finished.
+            self._prefetch_eof = True
+            error, self._prefetch_error = self._prefetch_error, None
+            if error is not None:
+                # It stopped because reading failed.
+                raise error
+            return None
+        stats["frames"] += 1
+        self._position = position
+        self._last_frame = frame
+        return frame
+
+    def _seek(self, prop, value):
+        """Set a capture property, stopping prefetching around it."""
+        prefetch = self._prefetch_thread is not None
+        if prefetch:
+            self.stop_prefetch(restore = False)
+        with self._cap_lock:
+            status = self._cap_set(prop, value)
+        if prefetch:
+            self.start_prefetch(self._prefetch_stats["depth"])
+        return status
+
+    def _need_keyframes(self):
+        """Build the keyframe index before the first seek, if it is to be
+           built at all. (See KEYFRAME_INDEX.)"""
+        if self._build_keyframes:
+            self._build_keyframes = False # Only try once.
+            self.keyframes = Keyframe_Index.for_video(self.path)
+
     #Current position of the video file in
     #milliseconds or video capture timestamp.
     def get_timestamp(self):
         """Get the position in the video in milliseconds."""
-        return self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        if self._prefetch_thread is not None:
+            return self._position[1]
+        return self._cap_get(cv2.CAP_PROP_POS_MSEC)
 
     def set_timestamp(self, timestamp):
         """Set the position in the video in milliseconds.
            Returns a status code."""
         # Add status meaning.
-        return self.cap.set(cv2.CAP_PROP_POS_MSEC, timestamp)
+        self._need_keyframes()
+        if self.keyframes is not None:
+            # Go to the frame instead so the keyframe index can be used.
+            return self.set_frame_index(int(round(timestamp / 1000. *
+                                                  self.get_fps())))
+        return self._seek(cv2.CAP_PROP_POS_MSEC, timestamp)
 
     #0-based index of the frame to be decoded/captured next.
     def get_frame_index(self):
         """Get the number of frames that have passed."""
-        return self.cap.get(cv2.CAP_PROP_POS_FRAMES)
+        if self._prefetch_thread is not None:
+            return self._position[0]
+        return self._cap_get(cv2.CAP_PROP_POS_FRAMES)
 
     def set_frame_index(self, frame_count):
         """Set the number of frames that have passed.
@@ -137,42 +544,180 @@ class Video():
         # Add status meaning.
         if frame_count < 0:
             frame_count = 0
-        return self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count)
+        self._need_keyframes()
+        if self.keyframes is not None:
+            return self._seek_keyframe(int(frame_count))
+        return self._seek(cv2.CAP_PROP_POS_FRAMES, frame_count)
+
+    def _seek_keyframe(self, frame_count):
+        """Go to frame_count, using the keyframe index to decode as few
+           frames as possible. Returns a status code."""
+        # Decoding has to start at the keyframe before frame_count. If the
+        # video is already before frame_count and not farther from it than
+        # that keyframe, reading forward is cheaper than any seek.
+        keyframe = self.keyframes.keyframe_before(frame_count)[0]
+        current = int(self.get_frame_index())
+        if current <= frame_count and \
+           frame_count - current <= frame_count - keyframe + SEEK_COST_FRAMES:
+            return self.skip_frames(frame_count - current) == \
+                   frame_count - current
+
+        # Otherwise, land on the keyframe and grab up to the frame.
+        status = self._seek(cv2.CAP_PROP_POS_FRAMES, keyframe)
+        if status is False:
+            return False
+        return self.skip_frames(frame_count - keyframe) == frame_count-keyframe
+
+    def skip_frames(self, count):
+        """Move forward count frames without converting them to images.
+           Returns the number of frames skipped, less than count at the end
+           of the file."""
+        if self._prefetch_thread is not None:
+            # Already being decoded, just take them off the queue.
+            for skipped in range(count):
+                if self._prefetch_get() is None:
+                    return skipped
+            return count
+        for skipped in range(count):
+            if not self._cap_grab():
+                return skipped
+        return count
+
+    def _goto(self, frame_count):
+        """Move to frame_count, grabbing forward when it is close and seeking
+           otherwise. Returns a status code."""
+        gap = frame_count - int(self.get_frame_index())
+        if 0 <= gap <= SEEK_COST_FRAMES:
+            # Not worth a seek. (With a keyframe index, set_frame_index makes
+            # the same choice for longer gaps.)
+            return self.skip_frames(gap) == gap
+        return self.set_frame_index(frame_count)
+
+    def sample_indices(self, step_seconds, start = 0, stop = None):
+        """Get the frame numbers every step_seconds from frame start to frame
+           stop (the end of the video by default)."""
+        if step_seconds is None or step_seconds <= 0:
+            raise ValueError("Need a positive step_seconds or indices.")
+        if stop is None:
+            stop = self.get_frame_count()
+        step = step_seconds * self.get_fps()
+        count = int(max(stop - start, 0) / step + 1)
+        indices = [int(round(start + n * step)) for n in range(count)]
+        return [index for index in indices if index < stop]
+
+    def read_burst(self, center_index, count, roi = None):
+        """Read count frames in a row around center_index with one seek.
+           The first frame is max(center_index - count // 2, 0).
+           Returns one array of shape (frames, height, width, 3) with fewer
+           than count frames at the end of the video.
+           If roi (x, y, width, height, in whole frame pixels) is given, only
+           that part of each frame is kept. It is clipped to the frames the
+           video gives, the region of interest if there is one.
+        """
+        # What get_frame gives, in whole frame pixels.
+        if self._roi is not None:
+            left, top, width, height = self._roi
+        else:
+            left, top = 0, 0
+            width, height = self.get_frame_width(), self.get_frame_height()
+
+        if roi is not None:
+            x, y, roi_width, roi_height = (int(value) for value in roi)
+            right = min(x + roi_width, left + width)
+            bottom= min(y + roi_height, top + height)
+            # Relative to the frames get_frame gives.
+            x, y = max(x, left) - left, max(y, top) - top
+            width, height = right - left - x, bottom - top - y
+            if width <= 0 or height <= 0:
+                raise ValueError("Region %r is not in the frames of %r."
+                                 % (roi, self.name))
+
+        start = max(int(center_index) - count // 2, 0)
+        self._goto(start)
+
+        frames = np.empty((count, height, width, 3), np.uint8)
+        for read in range(count):
+            frame = self.get_frame()
+            if frame is None:
+                return frames[:read]
+            if roi is not None:
+                frame = frame[y : y + height, x : x + width]
+            frames[read] = frame
+        return frames
+
+    def iter_sampled(self, step_seconds = None, indices = None, start = 0,
+                     stop = None, burst = None, skip = None):
+        """Go through a sample of the frames in one forward pass.
+           Either every step_seconds from frame start to frame stop (the end
+           of the video by default), or the frames numbered in indices.
+           Yields (frame_index, timestamp, frame), timestamp in milliseconds.
+           If burst is given, frame is instead the burst of that many frames
+           around frame_index (see read_burst), shorter at the end.
+           If skip is given and skip(frame_index) is true, nothing is decoded
+           for that sample and frame is None.
+
+           Skipped frames are grabbed but not converted when the next sample
+           is close, and seeked over (by keyframe when there is an index) when
+           it is far, so only the sampled frames are ever turned into images.
+        """
+        fps = self.get_fps()
+        if indices is None: indices = self.sample_indices(step_seconds, start, stop)
+        else: indices = sorted(set(int(index) for index in indices))  # One forward pass, so go in order.
+        for index in indices:
+            timestamp = index * 1000. / fps
+            if skip is not None and skip(index):
+                yield index, timestamp, None
+                continue
+            if burst is None:
+                self._goto(index)
+                frame = self.get_frame()
+                if frame is None: break  # End of the video.
+            else:
+                frame = self.read_burst(index, burst)
+                if not len(frame): break  # End of the video.
+            yield index, timestamp, frame
 
     #Relative position of the video file:
     #0 - start of the film, 1 - end of the film.
     def get_progress(self):
         """Get the percentage that is passed (0 to 1)."""
-        return self.cap.get(cv2.CAP_PROP_POS_AVI_RATIO)
+        if self._prefetch_thread is not None:
+            frame_count = self.get_frame_count()
+            return self._position[0] / frame_count if frame_count else 0.
+        return self._cap_get(cv2.CAP_PROP_POS_AVI_RATIO)
 
     def set_progress(self, progress):
         """Set the percentage that is passed (0 to 1).
            Returns a status code."""
         # Add status meaning.
-        return self.cap.set(cv2.CAP_PROP_POS_AVI_RATIO, progress)
+        return self._seek(cv2.CAP_PROP_POS_AVI_RATIO, progress)
 
     #Width of the frames in the video stream.
     def get_frame_width(self):
         """Get the width of the frames."""
         # Change to an integer as it should be.
-        return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        with self._cap_lock: # The decoder thread may be reading.
+            return int(self._cap_get(cv2.CAP_PROP_FRAME_WIDTH))
 
     #Height of the frames in the video stream.
     def get_frame_height(self):
         """Get the height of the frames."""
         # Change to an integer as it should be.
-        return int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        with self._cap_lock: # The decoder thread may be reading.
+            return int(self._cap_get(cv2.CAP_PROP_FRAME_HEIGHT))
 
     #Frame rate. Frames Per Second
     def get_fps(self):
         """Get the frames per second speed of the video."""
-        return self.cap.get(cv2.CAP_PROP_FPS)
+        with self._cap_lock: # The decoder thread may be reading.
+            return self._cap_get(cv2.CAP_PROP_FPS)
 
     #Number of frames in the video file.
     def get_frame_count(self):
         """Get the number of frames in the video file."""
         # passed as a float but has no buisness being a float.
-        return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        with self._cap_lock: # The decoder thread may be reading.
+            return int(self._cap_get(cv2.CAP_PROP_FRAME_COUNT))
 
     # Codes that I did not include.
 
@@ -199,19 +744,73 @@ class Video():
     cv2.CAP_PROP_ISO_SPEED      #The ISO speed of the camera (note: only supported by DC1394 v 2.x backend currently)
     cv2.CAP_PROP_BUFFERSIZE     #Amount of frames stored in internal buffer memory (note: only supported by DC1394 v 2.x backend currently)
 
+    # Region of interest.
+    # If only part of each frame is needed (like the scoreboard, see
+    # process_frames.scoreboard_roi), setting a region of interest makes
+    # get_frame return just that part as a small array of its own. The full
+    # frame is dropped right after decoding so it is never held, queued or
+    # copied around.
+    def get_roi(self):
+        """Get the region of interest (x, y, width, height) or None."""
+        return self._roi
+
+    def set_roi(self, roi):
+        """Set the region of interest (x, y, width, height) that get_frame
+           returns, or None for whole frames. The box is clipped to the frame.
+        """
+        if roi is not None:
+            x, y, width, height = (int(value) for value in roi)
+            x, y = max(x, 0), max(y, 0)
+            width = min(width, self.get_frame_width() - x)
+            height= min(height, self.get_frame_height() - y)
+            if width <= 0 or height <= 0:
+                raise ValueError("Region of interest %r is not in the frame."
+                                 % (roi,))
+            roi = x, y, width, height
+
+        prefetch = self._prefetch_thread is not None
+        if prefetch:
+            # Frames already in the queue were cropped with the old region.
+            self.stop_prefetch()
+        self._roi = roi
+        self._roi_changed()
+        if prefetch:
+            self.start_prefetch(self._prefetch_stats["depth"])
+
+    def _roi_changed(self):
+        """Called when the region of interest changes. cv2 crops after
+           decoding so there is nothing to do."""
+        pass
+
+    def _crop(self, frame):
+        """Cut the region of interest out of frame."""
+        if self._roi is None or frame is None:
+            return frame
+        x, y, width, height = self._roi
+        # Copy, so the full frame can be freed.
+        return frame[y : y + height, x : x + width].copy()
+
     def get_frame(self):
-        """Read the next frame."""
-        ret, frame = self.cap.read()
+        """Read the next frame.
+           Only the region of interest is returned if there is one."""
+        if self._prefetch_thread is not None:
+            return self._prefetch_get()
+        ret, frame = self._cap_read()
         if ret:
-            return frame
+            return self._crop(frame)
         return None
 
     def grab_frame(self):
         """Read the next frame but don't advance."""
-        ret, frame = self.cap.retrieve()
+        if self._prefetch_thread is not None:
+            # The capture is ahead, the last frame handed out is the current.
+            if self._last_frame is None:
+                raise RuntimeError("No frame to return.")
+            return self._last_frame
+        ret, frame = self._cap_retrieve()
         if ret is False:
             raise RuntimeError("No frame to return.")
-        return frame
+        return self._crop(frame)
 
     def closed(self):
         """Return if the video file is closed."""
@@ -219,8 +818,310 @@ class Video():
 
     def close(self):
         """Close the file and release the resources."""
+        self.stop_prefetch(restore = False)
         self.cap.release()
 
+def _fraction(text):
+    """Turn an ffprobe rate like "30000/1001" into a float."""
+    numerator, _, denominator = str(text).partition('/')
+    numerator = float(numerator)
+    if denominator:
+        denominator = float(denominator)
+        return numerator / denominator if denominator else 0.
+    return numerator
+
+def probe_video(path):
+    """Get the width, height, fps, duration (ms) and frame count of the first
+       video stream of path with ffprobe. Raises ValueError if there is no
+       video."""
+    command = [FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'stream=width,height,avg_frame_rate,'
+               'r_frame_rate,nb_frames,duration:format=duration',
+               '-of', 'json', path]
+    logging.debug(subprocess.list2cmdline(command))
+    data = json.loads(subprocess.check_output(command).decode())
+    if not data.get('streams'):
+        raise ValueError("No video stream in %r." % path)
+    stream = data['streams'][0]
+
+    fps = _fraction(stream.get('avg_frame_rate', 0)) or \
+          _fraction(stream.get('r_frame_rate', 0))
+    duration = stream.get('duration') or \
+               data.get('format', {}).get('duration') or 0
+    duration = float(duration) * 1000.
+    try:
+        frame_count = int(stream['nb_frames'])
+    except (KeyError, ValueError):
+        frame_count = int(round(duration * fps / 1000.))
+    if not fps:
+        raise ValueError("Could not find the frame rate of %r." % path)
+
+    return {'width'      : int(stream['width']),
+            'height'     : int(stream['height']),
+            'fps'        : fps,
+            'duration'   : duration,
+            'frame_count': frame_count}
+
+class FFmpeg_Video(Video):
+    """Video with the same api, but decoded by an ffmpeg subprocess writing
+       rawvideo to a pipe instead of by cv2.
+
+       This lets ffmpeg do the work that would otherwise be done on frames in
+       python. fps decimates the frame rate and size scales the frames
+       (fps and frame numbers are then those of the output) and a region of
+       interest is cropped by ffmpeg so the full frame never reaches python.
+       Seeks restart ffmpeg with a fast -ss seek, unless reading forward is
+       cheaper. threads is passed to ffmpeg's decoder.
+
+       Frames are read straight into a ring of preallocated buffers that are
+       reused instead of making a new array for each frame, so a frame is only
+       good until buffers more frames are read. Copy it to keep it longer.
+    """
+    def __init__(self, source, prefetch = 0, keyframe_index = None,
+                 fps = None, size = None, threads = None,
+                 buffers = FFMPEG_BUFFERS):
+        self.path = os.path.normpath(source)
+        self.name = os.path.basename(self.path)
+        if not os.path.exists(self.path):
+            # Bad file.
+            raise ValueError(
+                "The path %r is not a readable video file." % source)
+        try:
+            info = probe_video(self.path)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            raise ValueError(
+                "The path %r is not a readable video file." % source)
+
+        self._source_fps = info['fps']
+        self._source_size = info['width'], info['height']
+        self._duration = info['duration']
+        self._fps = float(fps) if fps else self._source_fps
+        self._size = tuple(int(n) for n in size) if size else self._source_size
+        self._threads = threads
+        self._buffer_count = max(int(buffers), 1)
+
+        self._process = None
+        self._closed = False
+        self._eof = False
+        self._start = 0. # Timestamp (ms) of the first frame from the process.
+        self._count = 0  # Frames read from the process so far.
+        self._last = None
+        self._ring = []
+        self._ring_index = 0
+        self._scratch = None
+
+        self._init_state(keyframe_index)
+        self._restart(0)
+        if prefetch:
+            self.start_prefetch(prefetch)
+
+    # The ffmpeg process.
+    def _filters(self):
+        """Build the -vf filter chain for the current settings."""
+        filters = []
+        if self._fps != self._source_fps:
+            filters.append('fps=%r' % self._fps)
+        if self._size != self._source_size:
+            filters.append('scale=%d:%d' % self._size)
+        if self._roi is not None:
+            x, y, width, height = self._roi
+            filters.append('crop=%d:%d:%d:%d' % (width, height, x, y))
+        return filters
+
+    def _frame_shape(self):
+        """The (height, width, channels) of the frames ffmpeg writes."""
+        if self._roi is not None:
+            return self._roi[3], self._roi[2], 3
+        return self._size[1], self._size[0], 3
+
+    def _kill(self):
+        """Stop the ffmpeg process if there is one."""
+        process, self._process = self._process, None
+        if process is not None:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+
+    def _restart(self, timestamp):
+        """Start ffmpeg decoding from timestamp (ms). Returns True."""
+        self._kill()
+        timestamp = max(float(timestamp), 0.)
+
+        command = [FFMPEG, '-nostdin', '-hide_banner', '-loglevel', 'error']
+        if self._threads:
+            command += ['-threads', str(self._threads)]
+        if timestamp:
+            # Before -i, so ffmpeg jumps to the keyframe and decodes from
+            # there instead of decoding everything before it.
+            command += ['-ss', '%.3f' % (timestamp / 1000.)]
+        command += ['-i', self.path, '-map', '0:v:0', '-an', '-sn']
+        filters = self._filters()
+        if filters:
+            command += ['-vf', ','.join(filters)]
+        command += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+        logging.debug(subprocess.list2cmdline(command))
+
+        self._process = subprocess.Popen(command, stdout = subprocess.PIPE,
+                                         stderr = subprocess.DEVNULL,
+                                         bufsize = 0)
+        self._start = timestamp
+        self._count = 0
+        self._eof = False
+        self._last = None
+        self._make_ring()
+        return True
+
+    def _make_ring(self, extra = 0):
+        """(Re)allocate the frame buffers if the frame shape or count changed.
+           extra is room for frames waiting in the prefetch queue."""
+        shape = self._frame_shape()
+        count = self._buffer_count + extra
+        if self._ring and self._ring[0][1].shape == shape and \
+           len(self._ring) >= count:
+            return
+        size = shape[0] * shape[1] * shape[2]
+        self._ring = []
+        for i in range(count):
+            buffer = bytearray(size)
+            frame = np.frombuffer(buffer, np.uint8).reshape(shape)
+            self._ring.append((memoryview(buffer), frame))
+        self._ring_index = 0
+        self._scratch = memoryview(bytearray(size))
+
+    def _fill(self, buffer):
+        """Read exactly one frame from ffmpeg into buffer. False at EOF."""
+        if self._process is None or self._eof:
+            return False
+        read = 0
+        size = len(buffer)
+        while read < size:
+            count = self._process.stdout.readinto(buffer[read:])
+            if not count:
+                self._eof = True
+                return False
+            read += count
+        self._count += 1
+        return True
+
+    def start_prefetch(self, depth = None):
+        """Start decoding up to depth frames ahead on a background thread."""
+        if depth is None:
+            depth = PREFETCH_DEPTH
+        if self._prefetch_thread is not None:
+            # The decoder thread must not be using the ring while it changes.
+            self.stop_prefetch()
+        # Queued frames still hold their buffers, make room for them.
+        self._make_ring(depth + 2)
+        Video.start_prefetch(self, depth)
+
+    # Backend.
+    def _cap_read(self):
+        """Decode the next frame. Returns (success, frame)."""
+        buffer, frame = self._ring[self._ring_index]
+        if not self._fill(buffer):
+            return False, None
+        self._ring_index = (self._ring_index + 1) % len(self._ring)
+        self._last = frame
+        return True, frame
+
+    def _cap_grab(self):
+        """Move past the next frame without keeping it. Returns success."""
+        return self._fill(self._scratch)
+
+    def _cap_retrieve(self):
+        """Get the frame last read. Returns (success, frame)."""
+        return self._last is not None, self._last
+
+    def _cap_get(self, prop):
+        """Get a cv2.CAP_PROP_* value."""
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self._start + self._count * 1000. / self._fps
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return round(self._start * self._fps / 1000.) + self._count
+        if prop == cv2.CAP_PROP_POS_AVI_RATIO:
+            if not self._duration:
+                return 0.
+            return self._cap_get(cv2.CAP_PROP_POS_MSEC) / self._duration
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self._size[0]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self._size[1]
+        if prop == cv2.CAP_PROP_FPS:
+            return self._fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return int(round(self._duration * self._fps / 1000.))
+        return 0
+
+    def _cap_set(self, prop, value):
+        """Set a cv2.CAP_PROP_* position. Returns a status code."""
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            timestamp = value
+        elif prop == cv2.CAP_PROP_POS_FRAMES:
+            timestamp = value * 1000. / self._fps
+        elif prop == cv2.CAP_PROP_POS_AVI_RATIO:
+            timestamp = value * self._duration
+        else:
+            return False
+        timestamp = max(float(timestamp), 0.)
+
+        # Read forward if that decodes less than seeking from the keyframe.
+        frame_length = 1000. / self._fps
+        ahead = (timestamp - self._cap_get(cv2.CAP_PROP_POS_MSEC))/frame_length
+        limit = SEEK_COST_FRAMES
+        if self.keyframes is not None:
+            keyframe_time = self.keyframes.keyframe_before_timestamp(timestamp)[1]
+            limit += (timestamp - keyframe_time) / frame_length
+        if self._process is not None and not self._eof and -.5 < ahead <= limit:
+            for i in range(int(round(ahead))):
+                if not self._cap_grab():
+                    return False
+            return True
+        return self._restart(timestamp)
+
+    # Positions are handled by _cap_set, which knows the keyframes already.
+    def set_timestamp(self, timestamp):
+        """Set the position in the video in milliseconds.
+           Returns a status code."""
+        self._need_keyframes()
+        return self._seek(cv2.CAP_PROP_POS_MSEC, timestamp)
+
+    def set_frame_index(self, frame_count):
+        """Set the number of frames that have passed.
+           Returns a status code."""
+        self._need_keyframes()
+        return self._seek(cv2.CAP_PROP_POS_FRAMES, max(frame_count, 0))
+
+    def _crop(self, frame):
+        """ffmpeg already cropped the frame."""
+        return frame
+
+    def _roi_changed(self):
+        """Restart ffmpeg with the new crop where the video is now."""
+        self._restart(self._cap_get(cv2.CAP_PROP_POS_MSEC))
+
+    def closed(self):
+        """Return if the video file is closed."""
+        return self._closed
+
+    def close(self):
+        """Close the file and release the resources."""
+        self.stop_prefetch(restore = False)
+        self._kill()
+        self._closed = True
+
+BACKENDS = {"cv2": Video, "ffmpeg": FFmpeg_Video}
+
+def open_video(source, backend = "cv2", **options):
+    """Open source with the named backend ("cv2" or "ffmpeg").
+       options are passed on to the Video class."""
+    try:
+        video_class = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown video backend %r, not one of %s." %
+                         (backend, ", ".join(sorted(BACKENDS))))
+    return video_class(source, **options)
+
 def test():
     global video
     video = Video('Examples/Saturday 3-11-17_ND.mp4')
@@ -245,15 +1146,9 @@ def test():
         video.close()
         cv2.destroyAllWindows()
 
-# elif ffmpeg:
-# For ffmpeg compatability it should be possible to use the code found at
+# The ffmpeg backend (FFmpeg_Video) pipes rawvideo out of an ffmpeg process,
+# much like the moviepy reader at
 # https://github.com/Zulko/moviepy/blob/master/moviepy/video/io/ffmpeg_reader.py
-# https://github.com/dschreij/opensesame-plugin-media_player_mpy/
-
-# These should be enough to make everything work with ffmpeg, though not well.
-# That said. I am not taking the time now to build the ffmpeg support out.
-# Also, look the libraries opensesame-plugin-media_player_mpy, mediadecoder,
-# and moviepy
 
 if __name__ == '__main__':
     test()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Follow a folder the recorder is writing videos into. The videos in it are
+scanned while they are still being written with find_matches.stream_matches.
+
+Folder_Watcher(folders)     Tells when the files in folders change. Uses
+                            inotify if inotify_simple is installed, otherwise
+                            looks at the folders every poll seconds.
+"""
+import os
+import time
+import logging
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+__all__ = ["Folder_Watcher", "WATCH_POLL", "WATCH_SETTLE"]
+
+WATCH_POLL = 2. # Seconds between looks at the folders (or inotify timeout).
+WATCH_SETTLE = 30. # Seconds a file has to stay the same to be complete.
+
+class Folder_Watcher(object):
+    """Folder_Watcher(folders, poll = WATCH_POLL, settle = WATCH_SETTLE,
+                      use_inotify = None)
+       Watch the files in folders. A file is complete when it is closed
+       after writing or moved in (with inotify), or when it has not changed
+       for settle seconds. use_inotify is None to use it if it is installed.
+    """
+    def __init__(self, folders, poll = None, settle = None,
+                 use_inotify = None):
+        self.folders = list(folders)
+        self.poll = WATCH_POLL if poll is None else poll
+        self.settle = WATCH_SETTLE if settle is None else settle
+        self.files = {} # path -> ((size, mtime), time it was last changed)
+        self.complete = set()
+
+        if use_inotify is None:
+            use_inotify = inotify_simple is not None
+        elif use_inotify and inotify_simple is None:
+            raise ImportError("inotify_simple is not installed.")
+        self.inotify = None
+        if use_inotify:
+            flags = inotify_simple.flags
+            self.inotify = inotify_simple.INotify()
+            self.folder_of = {} # watch descriptor -> folder
+            for folder in self.folders:
+                descriptor = self.inotify.add_watch(
+                    folder, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE |
+                            flags.MOVED_TO)
+                self.folder_of[descriptor] = folder
+        logging.debug("Watching %s with %s." %
+                      (", ".join(self.folders),
+                       "inotify" if self.inotify else "polling"))
+
+    def _stat(self):
+        """{path: (size, mtime)} of the files in the folders."""
+        files = {}
+        for folder in self.folders:
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # Gone already.
+                if os.path.isfile(path):
+                    files[path] = stat.st_size, stat.st_mtime
+        return files
+
+    def _wait(self):
+        """Wait for the next look. Returns the paths that were closed after
+           writing or moved in since the last one."""
+        if self.inotify is None:
+            time.sleep(self.poll)
+            return set()
+        flags = inotify_simple.flags
+        closed = set()
+        for event in self.inotify.read(timeout = int(self.poll * 1000)):
+            if event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                closed.add(os.path.join(self.folder_of[event.wd], event.name))
+        return closed
+
+    def changes(self, idle_exit = None):
+        """Yield (path, complete) each time a file is new or changed, and
+           once more when it is complete.
+           If idle_exit is given, stop after that many seconds of nothing.
+        """
+        closed = set()
+        idle_since = time.time()
+        while True:
+            now = time.time()
+            for path, stat in sorted(self._stat().items()):
+                known = self.files.get(path)
+                if known is None or known[0] != stat:
+                    # New or changed.
+                    self.files[path] = stat, now
+                    self.complete.discard(path)
+                elif path in self.complete or \
+                     (path not in closed and now - known[1] < self.settle):
+                    continue # Nothing new.
+                complete = path in closed or (known is not None and
+                                              known[0] == stat)
+                if complete:
+                    self.complete.add(path)
+                idle_since = now
+                yield path, complete
+            if idle_exit is not None and time.time() - idle_since >= idle_exit:
+                return
+            closed = self._wait()
+
+    def close(self):
+        """Stop watching."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None